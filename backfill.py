@@ -0,0 +1,204 @@
+'''Loads archived dat files into the database a chunk of rows at a time, so a
+decade of data fits in memory and a failure only loses the chunk it
+happened in.  Each chunk goes through the same parsing as DatFile, has the
+rows already in the database taken out and is committed before a checkpoint
+records how far into the file it got.  Running the same command again picks
+up from the checkpoints.  The files are loaded at the same time in separate
+processes.
+
+python backfill.py SBSP /archive/SBSP_2010.dat /archive/SBSP_2011.dat --workers 4
+
+Run python rollups.py --rebuild and python gaps.py --rebuild afterwards to
+update the daily rollups and the gap index.
+'''
+import argparse
+import json
+import time
+from hashlib import sha1
+from concurrent.futures import ProcessPoolExecutor
+from os import makedirs, replace
+from os.path import join, basename, getsize, abspath, exists as fileexists
+from itertools import islice
+from config import *
+from data_access import get_header_info
+from metrics import stage, count, write_textfile
+from upload_dats import DatFile, parse_datlines, insert_frame
+
+try:
+    import resource
+except ImportError:   # WINDOWS, THE PEAK RSS ISNT REPORTED
+    resource = None
+
+backfill_checkpoint_dir = join(upload_logfile_dir, 'backfill')
+# TIMES A CHUNK IS TRIED AGAIN, WAITING retry_backoff_secs AND THEN TWICE AS
+# LONG EACH TIME
+chunk_retries = 3
+
+
+def checkpoint_path(station, datfile_path):
+    '''The checkpoint of a file, named after it and a hash of its full path
+    so archives with the same name in different directories each get one'''
+    return join(backfill_checkpoint_dir, '%s_%s_%s.json' % (
+                    station, basename(datfile_path).replace(' ', '_'),
+                    sha1(abspath(datfile_path).encode()).hexdigest()[:12]))
+
+
+def peak_rss_mb(who='self'):
+    '''The peak RSS in MB of this process, or with who='children' of the
+    largest process it started, None where resource isnt available'''
+    if resource is None:
+        return None
+    # ru_maxrss IS IN KB ON LINUX
+    who = resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN
+    return resource.getrusage(who).ru_maxrss / 1024.
+
+
+def _mb(mb):
+    return 'unknown' if mb is None else '%.0f MB' % mb
+
+
+def load_checkpoint(station, datfile_path):
+    '''Returns the byte offset and rows loaded so far, starting over if the
+    file is now shorter than the checkpoint'''
+    path = checkpoint_path(station, datfile_path)
+    if not fileexists(path):
+        return 0, 0
+    with open(path, 'r') as f:
+        checkpoint = json.load(f)
+    if checkpoint['datfile_path'] != abspath(datfile_path) or \
+            getsize(datfile_path) < checkpoint['offset']:
+        return 0, 0
+    return checkpoint['offset'], checkpoint['rows']
+
+
+def save_checkpoint(station, datfile_path, offset, rows):
+    path = checkpoint_path(station, datfile_path)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'datfile_path': abspath(datfile_path), 'offset': offset,
+                   'rows': rows}, f)
+    replace(path + '.tmp', path)
+
+
+def read_chunks(datfile_path, offset=0, chunk_rows=100000):
+    '''Yields the bytes of chunk_rows lines at a time from offset on, with the
+    offset after each chunk.  The last line of the file is read even without
+    a newline, archives arent written to any more'''
+    with open(datfile_path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            lines = list(islice(f, chunk_rows))
+            if not lines:
+                return
+            data = b''.join(lines)
+            if not data.endswith(b'\n'):
+                data += b'\n'
+            offset += sum(len(line) for line in lines)
+            yield data, offset
+
+
+def backfill_file(station, datfile_path, chunk_rows=100000, method='copy'):
+    '''Loads one dat file chunk by chunk.  Returns the rows read and inserted,
+    the seconds it took and the peak RSS of the process in MB'''
+    started = time.time()
+    header = get_header_info(station)
+    offset, inserted = load_checkpoint(station, datfile_path)
+    read = 0
+
+    for data, offset in read_chunks(datfile_path, offset, chunk_rows):
+        with stage('backfill_chunk', station=station) as m:
+            rawfile = parse_datlines(data, header)
+            # LOGGERNET BACKUPS CAN REPEAT ROWS
+            rawfile = rawfile[~rawfile.index.duplicated(keep='last')]
+            dat = DatFile.from_rows(station, datfile_path, rawfile)
+            if station in ('SASP','SBSP'):
+                dat.add_albedo()
+            dat.add_qc_flags()
+
+            # FILES THAT OVERLAP CAN INSERT THE SAME ROWS AT THE SAME TIME,
+            # LOOKING FOR THE ROWS IN THE DATABASE AGAIN SEES THE OTHER
+            # PROCESS'S ROWS ONCE IT HAS COMMITTED
+            for attempt in range(chunk_retries + 1):
+                try:
+                    upload = dat
+                    if not (method == 'upsert' and
+                            engine.dialect.name == 'postgresql'):
+                        upload = dat.clear_rows_already_in_database(inplace=False)
+                    n = 0
+                    if upload.rawfile.shape[0]:
+                        n = insert_frame(upload.rawfile.reset_index(), dat.table,
+                                         method, chunksize=50000)
+                    break
+                except Exception as e:
+                    if attempt == chunk_retries:
+                        raise
+                    print('Chunk of %s failed, trying again: %r' % (
+                              datfile_path, e))
+                    count('backfill_chunk_retries', station=station)
+                    time.sleep(retry_backoff_secs * 2 ** attempt)
+            read += rawfile.shape[0]
+            inserted += n
+            m['rows'] = rawfile.shape[0]
+            m['rows_inserted'] = n
+        # ONLY AFTER THE CHUNK IS COMMITTED
+        save_checkpoint(station, datfile_path, offset, inserted)
+
+    return {'datfile_path': datfile_path, 'rows_read': read,
+            'rows_inserted': inserted, 'secs': time.time() - started,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def _start_worker():
+    # THE FORKED PROCESS CANT SHARE THE PARENT'S DATABASE CONNECTIONS
+    engine.dispose()
+
+
+def backfill(station, datfile_paths, chunk_rows=100000, method='copy',
+             workers=db_pool_size):
+    '''Runs backfill_file on each file in its own process, printing the rows
+    per second of each file and of the whole backfill'''
+    makedirs(backfill_checkpoint_dir, exist_ok=True)
+    started = time.time()
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_start_worker) as pool:
+        futures = [pool.submit(backfill_file, station, path, chunk_rows, method)
+                   for path in datfile_paths]
+        results = []
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            print('%s: %i rows read, %i inserted in %.1f s, %.0f rows/s, '
+                  'peak RSS %s' % (
+                      result['datfile_path'], result['rows_read'],
+                      result['rows_inserted'], result['secs'],
+                      result['rows_read'] / max(result['secs'], 1e-9),
+                      _mb(result['peak_rss_mb'])))
+
+    secs = time.time() - started
+    rows = sum(result['rows_read'] for result in results)
+    peak_mb = None
+    if resource is not None:
+        peak_mb = max(peak_rss_mb('self'), peak_rss_mb('children'))
+    print('Backfilled %i rows from %i files in %.1f s, %.0f rows/s, '
+          'largest process peak RSS %s' % (
+              rows, len(results), secs, rows / max(secs, 1e-9), _mb(peak_mb)))
+    write_textfile('backfill')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('station', type=str, choices=sorted(tablenames),
+                        help='the station the dat files are from, like SBSP')
+    parser.add_argument('datfiles', nargs='+',
+                        help='the archived dat files to load')
+    parser.add_argument('--chunk_rows', type=int, default=100000,
+                        help='how many lines of a file to read and commit at once')
+    parser.add_argument('--method', choices=['copy', 'upsert', 'to_sql'],
+                        default='copy', help='see DatFile.upload2db')
+    parser.add_argument('--workers', type=int, default=db_pool_size,
+                        help='how many files to load at the same time')
+    args = parser.parse_args()
+
+    backfill(args.station, args.datfiles, args.chunk_rows, args.method,
+             args.workers)
@@ -0,0 +1,131 @@
+'''Makes several plot pages in one run, fetching the data for all of them with
+one set of queries.  The manifest is a json list of jobs like:
+
+[{"template": "/fullpath/to/public.json", "output": "/fullpath/to/public.html",
+  "tdelta_days": 40, "tdelta_days_showing": 7,
+  "remote_filepath": "/fullpath/to/public.html/on/remote/server"},
+ {"template": "/fullpath/to/season.json", "output": "/fullpath/to/season.html",
+  "tdelta_days": 365, "tdelta_days_showing": 120}]
+
+remote_filepath is only needed with --sftp_to.  Every line of every template
+is read once over the widest window and each page gets its own days and
+columns from that.  The options work like the ones of plotter.py and
+apply to every page.  As an example:
+
+python batch_plotter.py /fullpath/to/manifest.json --sftp_to 124.234.12.44 --remote_username matt --remote_password mypassword
+'''
+import argparse
+import json
+import time
+from datetime import datetime as dtm, timedelta
+from config import *
+from data_access import get_data, column_name
+from downsample import modes as downsample_modes
+from result_cache import ResultCache
+from sftp import SftpClient
+from gaps import report_outages
+from metrics import stage, count, write_textfile
+from plotter import (read_template, template_lines, check_arguments, plot_state,
+                     state_unchanged, save_state, render, remote_paths,
+                     upload_rendered, plot_width)
+
+
+def read_manifest(manifestfile, sftp=False):
+    '''Reads the jobs in a manifest file and checks them like plotter.py
+    checks its arguments.  With sftp every job needs a remote_filepath'''
+    with open(manifestfile, 'r') as f:
+        jobs = json.load(f)
+    for job in jobs:
+        check_arguments(job['output'], job['template'], job['tdelta_days'],
+                        job['tdelta_days_showing'])
+        if sftp and not job.get('remote_filepath'):
+            raise RuntimeError('%s has no remote_filepath to sftp it to' %
+                               job['output'])
+    return jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest',
+                        help='the full path to the json manifest of plots to make',
+                        type=str)
+    parser.add_argument('--sftp_to', dest='remote_ip', default=False, type=str)
+    parser.add_argument('--remote_username', default=False, type=str)
+    parser.add_argument('--remote_password', default=False, type=str)
+    parser.add_argument('--downsample', choices=downsample_modes,
+                        default='none', type=str)
+    parser.add_argument('--points_per_pixel', default=2, type=float)
+    parser.add_argument('--auto_resolution', action='store_true')
+    parser.add_argument('--cache_dir', default=False, type=str)
+    parser.add_argument('--force', action='store_true')
+    parser.add_argument('--external_data', action='store_true')
+    parser.add_argument('--qc', action='store_true')
+    args = parser.parse_args()
+    started = time.time()
+
+    jobs = read_manifest(args.manifest, sftp=bool(args.remote_ip))
+    interval = 'auto' if args.auto_resolution else '1 Hour'
+    end = dtm.now()
+    for job in jobs:
+        job['templ'] = read_template(job['template'])
+        job['lines'] = template_lines(job['templ'])
+        job['start'] = end + timedelta(days=-job['tdelta_days'])
+        job['n_points'] = plot_width * args.points_per_pixel * \
+                          job['tdelta_days'] / job['tdelta_days_showing']
+
+    # ONE FETCH OVER THE WIDEST WINDOW, DENSE ENOUGH FOR THE PAGE THAT NEEDS
+    # THE MOST POINTS PER DAY
+    start = min(job['start'] for job in jobs)
+    days = (end - start).total_seconds() / 86400.
+    n_points = days * max(job['n_points'] / job['tdelta_days'] for job in jobs)
+
+    # SKIPPING THE PAGES THAT WOULD COME OUT THE SAME AS LAST TIME
+    options = dict((k, v) for k, v in vars(args).items()
+                   if k not in ('force', 'manifest'))
+    todo = []
+    for job in jobs:
+        arguments = dict(options, **dict((k, job[k]) for k in (
+                         'template', 'output', 'tdelta_days',
+                         'tdelta_days_showing', 'remote_filepath') if k in job))
+        job['state'] = plot_state(job['template'], arguments, job['lines'],
+                                  interval, start, end, n_points)
+        if not args.force and state_unchanged(job['output'], job['state']):
+            print('Nothing changed since the last run, not remaking %s' % job['output'])
+            count('plots_skipped')
+        else:
+            todo.append(job)
+
+    if todo:
+        lines = [line for job in todo for line in job['lines']]
+        cache = ResultCache(args.cache_dir, result_cache_max_days) if args.cache_dir else None
+        fetch_started = time.time()
+        with stage('get_data') as m:
+            df = get_data(lines, start, end, interval, min_points=n_points,
+                          cache=cache, qc=args.qc)
+            m['rows'] = df.shape[0]
+        print('Fetched %i rows and %i columns for %i pages in %.1f seconds' % (
+              df.shape[0], df.shape[1], len(todo), time.time() - fetch_started))
+        report_outages(lines, start, end, interval, n_points)
+
+        uploads = []
+        for job in todo:
+            columns = sorted(set(column_name(line) for line in job['lines']))
+            start_initial = end + timedelta(days=-job['tdelta_days_showing'])
+            files = render(job['templ'], df.loc[df.index >= job['start'], columns],
+                           job['output'], start_initial, end, job['n_points'],
+                           args.downsample, args.external_data)
+            if args.remote_ip:
+                uploads += remote_paths(files, job['remote_filepath'])
+
+        # EVERY PAGE GOES UP AT ONCE OVER ONE CONNECTION, AFTER THEIR DATA
+        if uploads:
+            sftp = SftpClient(args.remote_ip,22,args.remote_username,args.remote_password)
+            upload_rendered(sftp, uploads)
+            sftp.close()
+        for job in todo:
+            save_state(job['output'], job['state'])
+
+    print('Made %i of %i pages in %.1f seconds' % (len(todo), len(jobs),
+                                                  time.time() - started))
+    write_textfile('batch_plotter')
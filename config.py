@@ -9,7 +9,26 @@ from os.path import join
 #engine = create_engine('mysql+mysqldb://csasdb:Csas1040!:192.186.235.162/snowstudies?charset=utf8mb4&binary_prefix=true' )# NOTE WE NEED TO PUT YOUR PASSWORD IN AN ENVIRONMENT VARIABLE
 #engine = create_engine('mysql+mysqldb://csasdb:%s@192.186.235.162:3306/snowstudies' % getenv(
 #	                   'CSAS_DB_PASSWORD'))
-engine = create_engine('postgresql+psycopg2://postgres:%s@localhost/csas' % 'letitsnow')
+db_url = getenv('CSAS_DB_URL',
+                'postgresql+psycopg2://postgres:%s@localhost/csas' % 'letitsnow')
+# SET CSAS_DB_URL TO POINT EVERYTHING AT A DIFFERENT DATABASE, LIKE A SCRATCH ONE FOR BENCHMARKS
+
+# THE MOST DATABASE CONNECTIONS OPEN AT ONCE, THIS IS ALSO HOW MANY STATIONS
+# ARE UPLOADED OR QUERIED FOR PLOTS AT THE SAME TIME
+db_pool_size = 4
+if db_url.startswith('sqlite'):
+    engine = create_engine(db_url)
+else:
+    engine = create_engine(db_url, pool_size=db_pool_size, max_overflow=0,
+                           pool_pre_ping=True)
+
+# SECONDS A QUERY FOR PLOT DATA CAN TAKE, AND HOW MANY TIMES A FAILED ONE IS
+# TRIED AGAIN, WAITING retry_backoff_secs, THEN TWICE THAT AND SO ON.  ONLY
+# POSTGRESQL, MYSQL AND SQLITE STOP A QUERY THAT RUNS OVER, ON OTHER DATABASES
+# A HUNG QUERY STILL HOLDS UP THE END OF THE RUN
+query_timeout_secs = 120
+query_retries = 3
+retry_backoff_secs = 1
 
 print('PASSWORD from config.py',getenv('CSAS_PG_PWD'))
 # DIRECTORY HOLDING THE STATION INFO DATA FILES
@@ -22,11 +41,29 @@ datfiledir = '/home/ubuntu/CSASPlotter/'
 # DIRECTORY HOLDING THE LOG FILES THAT RECORD EACH UPLOAD AND ITS SUCCESS OR FAILURE
 # upload_logfile_dir = 'C:\\Users\\Kimberly\\Documents\\python-data-transfer\\CSASPlotter'
 upload_logfile_dir = '/home/ubuntu/CSASPlotter/'
+
+# JSON LINES WITH HOW LONG EACH STAGE OF THE UPLOADS AND PLOTS TOOK GO IN
+# metrics_logfile.  SET CSAS_METRICS_DIR TO node_exporter's TEXTFILE COLLECTOR
+# DIRECTORY TO ALSO WRITE THEM FOR PROMETHEUS
+metrics_logfile = join(upload_logfile_dir, 'csas_metrics.log')
+metrics_textfile_dir = getenv('CSAS_METRICS_DIR')
 #############################################################################
 #############################################################################
 # THIS STUFF YOU MIGHT NEED TO CHANGE BUT I THINK YOU ARE OK
 stationxlsfile = join(stationinfodir, 'Field_Lists.xlsx')
 
+# COMPILED COPIES OF Field_Lists.xlsx AND THE DATA ARRAY FILES, THEY ARE MADE
+# AGAIN WHENEVER THE ORIGINAL FILE CHANGES
+metadata_cachedir = join(stationinfodir, '.cache')
+
+# plotter.py --cache_dir KEEPS THIS MANY DAYS OF PLOT DATA, THIS SHOULD BE AT
+# LEAST THE LONGEST tdelta_days YOU RUN IT WITH
+result_cache_max_days = 366
+
+# HOW DATETIMES ARE WRITTEN IN THE SQL, WITH THE MICROSECONDS SO THE BOUNDS
+# COMPARE RIGHT AGAINST THE TEXT SQLITE STORES THEM AS TOO
+datefmt = '%Y-%m-%d %H:%M:%S.%f'
+
 tablenames = dict(SASP='swamp_angel', SBSP='senator_beck',
                   SBSG='senator_beck_stream', PTSP='putney')
 
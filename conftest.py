@@ -0,0 +1,22 @@
+'''Points the tests at a scratch SQLite database, config.py reads
+CSAS_DB_URL when it is first imported'''
+import os
+import tempfile
+import pytest
+
+scratch = tempfile.mkdtemp()
+os.environ['CSAS_DB_URL'] = 'sqlite:///' + os.path.join(scratch, 'csas_test.db')
+
+
+@pytest.fixture
+def sbsp_table(tmpdir):
+    '''An empty SBSP table in the scratch database'''
+    from config import engine, tablenames
+    from upload_dats import create_table_sql
+    realtable = tablenames['SBSP']
+    table = tablenames['SBSP'] = 'test_senator_beck'
+    create_table_sql('SBSP', table, execute=True)
+    yield table
+    tablenames['SBSP'] = realtable
+    for name in (table, table + '_daily', table + '_gaps'):
+        engine.execute('DROP TABLE IF EXISTS %s' % name)
@@ -1,15 +1,84 @@
 from config import *
 import pandas as pd
-from os import getenv
+from os import getenv, stat, makedirs, replace
 import numpy as np
+import pickle
+from threading import Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from contextlib import contextmanager
+from datetime import datetime as dtm
+import time
+from metrics import stage, count
 [
 {"field":"loair_avg_c", "station": "SBSP"},
 {"field":"loair_avg_c", "station": "SASP"},
 {"field":"air_avg_c", "station": "PTSP"}]
 
-def get_data_from_station(station, fields, start, end, interval):
+# FLOAT COLUMNS ARE KEPT AS float32 WHEN EVERY VALUE COMES BACK WITHIN THIS
+# RELATIVE ERROR, THE DATABASE STORES THEM AS real SO NOTHING MORE IS LOST
+float32_rtol = 1e-6
 
-    sql = 'SELECT datetime, {field} as {station}_{field} ' + \
+def field_dtypes(header):
+    '''The compact dtype of each field of a station from the Data_Type column
+    of Field_Lists.xlsx, int16 for the columns that make up the key and
+    float32 for the rest.  Integer fields are float32 too because the arrays
+    that dont record them leave them blank'''
+    dtypes = OrderedDict()
+    for field, data_type in header.Data_Type.str.strip().items():
+        if field in ('arrayid', 'year', 'doy', 'hour'):
+            dtypes[field] = 'int16'
+        elif data_type in ('Float', 'Integer'):
+            dtypes[field] = 'float32'
+    return dtypes
+
+def _compact_column(name, values, dtype, rtol):
+    '''Returns values as dtype if they come back the same, within rtol or
+    exactly for whole numbers, otherwise values as they were'''
+    if dtype is None or values.dtype == dtype or values.dtype.kind not in 'iuf':
+        return values
+    original = values.astype(np.float64)
+    missing = np.isnan(original)
+    with np.errstate(over='ignore', invalid='ignore'):
+        compact = values.astype(dtype)
+    present = original[~missing]
+    tolerance = 0 if np.all(present == np.floor(present)) else rtol
+    fits = np.allclose(compact.astype(np.float64), original, rtol=tolerance,
+                       atol=0, equal_nan=True)
+    if np.dtype(dtype).kind in 'iu' and missing.any():
+        fits = False
+    if not fits:
+        print('Keeping %s as %s, its values dont fit in %s' % (
+                  name, values.dtype, dtype))
+        count('dtype_fallbacks', column=name)
+        return values
+    return compact
+
+def compact_frame(df, dtypes=None, rtol=float32_rtol):
+    '''Returns df with its columns in the dtypes of a dict like the one
+    field_dtypes makes, by default every float64 column as float32.  A
+    column is only changed if its values come back within rtol, and whole
+    numbers exactly, otherwise it is printed and left as it was'''
+    if dtypes is None:
+        dtypes = dict((column, 'float32') for column in df.columns
+                      if df[column].dtype == np.float64)
+    if df.shape[0] == 0:
+        return df
+    # ONE NEW FRAME INSTEAD OF REPLACING COLUMNS, WHICH COPIES THE REST OF
+    # THE FLOAT64 BLOCK EVERY TIME
+    columns = OrderedDict((column, _compact_column(column, df[column].values,
+                                                   dtypes.get(column), rtol))
+                          for column in df.columns)
+    return pd.DataFrame(columns, index=df.index, columns=df.columns)
+
+def get_data_from_station(station, fields, start, end, interval, qc=False):
+    '''Queries one or more fields from a station table, each field is
+    returned in a column named like sasp_loair_avg_c.  With qc=True the
+    values flagged by their Data Check range come back as NaN'''
+    from qc import qc_checks, checked_column_sql
+
+    sql = 'SELECT datetime, {columns} ' + \
           'FROM {table} ' + \
           "WHERE arrayid = {arrayid} AND " + \
           "datetime BETWEEN '{start}' AND '{end}'"
@@ -20,45 +89,309 @@ def get_data_from_station(station, fields, start, end, interval):
     da = get_data_arrays(station)
     arrayid = da[da.label == interval].index[0]
 
-    if type(fields) in (list, tuple):
-        fields = ', '.join(fields)
-    sql = sql.format(field=fields, table=tablenames[station],
-               start=start.strftime("%Y-%m-%d %H:%M:%S"),
-               end=end.strftime("%Y-%m-%d %H:%M:%S"),
-               arrayid=arrayid,
-               station=station)
-
-    try:
-        df = pd.read_sql_query(sql, engine, parse_dates=True, index_col='datetime')
-    except Exception:   # IF FAILED TRY AGAIN  SOMETIMES THE FIRST SEEMS TO FAIL
-        df = pd.read_sql_query(sql, engine, parse_dates=True, index_col='datetime')
+    if type(fields) not in (list, tuple):
+        fields = [fields]
+    checks = qc_checks(station) if qc else None
+    columns = ', '.join('{column} as {station}_{field}'.format(
+                            column=checked_column_sql(station, field, checks)
+                                   if qc else field,
+                            field=field, station=station.lower())
+                        for field in fields)
+    sql = sql.format(columns=columns, table=tablenames[station],
+               start=start.strftime(datefmt),
+               end=end.strftime(datefmt),
+               arrayid=arrayid)
 
+    with stage('query', station=station, interval=interval) as m:
+        df = read_sql_with_retry(sql)
+        m['rows'] = df.shape[0]
     return df
 
-def get_data(fieldslist, start, end, interval='1 Hour'):
+def read_sql_with_retry(sql, timeout_secs=query_timeout_secs,
+                        retries=query_retries):
+    '''Reads a query into a dataframe indexed by datetime.  If it fails it is
+    tried again up to retries times, waiting retry_backoff_secs and then
+    twice as long each time, as long as that fits in timeout_secs.  The
+    database also stops the query after timeout_secs on PostgreSQL, MySQL
+    and SQLite, see _query_timeout'''
+    deadline = time.time() + timeout_secs
+    for attempt in range(retries + 1):
+        try:
+            with engine.connect() as conn, conn.begin(), \
+                    _query_timeout(conn, deadline):
+                return pd.read_sql_query(sql, conn, parse_dates=['datetime'],
+                                         index_col='datetime')
+        except Exception:
+            delay = retry_backoff_secs * 2 ** attempt
+            if attempt == retries or time.time() + delay >= deadline:
+                raise
+            print('Query failed at %s, trying again in %s seconds' % (
+                      dtm.now(), delay))
+            count('query_retries')
+            time.sleep(delay)
 
-    dfs = [get_data_from_station(st['station'],
-                                 st['field'],
-                                 start,
-                                 end,
-                                 interval) for st in fieldslist]
+@contextmanager
+def _query_timeout(conn, deadline):
+    '''Has the database stop the queries run on conn inside it at deadline.
+    Python cant stop a thread stuck in a query, and waits for the threads of
+    _fetch_plan before it exits, so this is what keeps a hung station from
+    holding up a run.  Other databases get no timeout'''
+    remaining = max(deadline - time.time(), 0.001)
+    if engine.dialect.name == 'postgresql':
+        conn.execute('SET LOCAL statement_timeout = %i' % (remaining * 1000))
+        yield
+    elif engine.dialect.name == 'mysql':
+        # SESSION WIDE, THE CONNECTION GOES BACK TO THE POOL AFTERWARDS
+        conn.execute('SET SESSION max_execution_time = %i' % (remaining * 1000))
+        try:
+            yield
+        finally:
+            conn.execute('SET SESSION max_execution_time = 0')
+    elif engine.dialect.name == 'sqlite':
+        # SQLITE CALLS THIS EVERY 1000 STEPS OF THE QUERY AND STOPS IT WITH
+        # "interrupted" ONCE IT RETURNS TRUE
+        raw = conn.connection
+        raw.set_progress_handler(lambda: time.time() > deadline, 1000)
+        try:
+            yield
+        finally:
+            raw.set_progress_handler(None, 1000)
+    else:
+        yield
 
-    # CONCATENATING ALL DATAFRAMES
-    out = pd.concat(dfs, names=[st['station'] for st in fieldslist], axis=1)
+def choose_interval(station, start, end, min_points):
+    '''Returns the label of the coarsest regular data array (1, 3 or 24
+    Hour) of a station that still has min_points between start and end.  If
+    none of them do the finest one is returned'''
+    da = regular_arrays(station).sort_values('intervalminutes')
 
-    # REMOVING COLUMNS IF THEY ARE DUPLICATED
-    idx = np.unique(out.columns.values, return_index=True)[1]
-    out = out.iloc[:, idx]
-    return out
+    span_minutes = (end - start).total_seconds() / 60.
+    enough = da[span_minutes / da.intervalminutes >= min_points]
+    if enough.shape[0]:
+        return enough.label.iloc[-1]
+    return da.label.iloc[0]
+
+def finer_interval(station, interval):
+    '''Returns the label of the next finer regular data array of a station,
+    or None if interval is already the finest'''
+    da = regular_arrays(station).set_index('label')
+    finer = da.intervalminutes[da.intervalminutes < da.intervalminutes[interval]]
+    return finer.idxmax() if len(finer) else None
+
+def column_name(line):
+    '''The column get_data returns a line in, like sasp_loair_avg_c or
+    sasp_loair_avg_c_max for a line with an aggregate'''
+    name = '%s_%s' % (line['station'].lower(), line['field'])
+    if line.get('aggregate'):
+        name += '_' + line['aggregate']
+    return name
+
+def plan_queries(fieldslist, interval='1 Hour', start=None, end=None,
+                 min_points=None, fallback=False):
+    '''Groups the lines in fieldslist by station table and interval so each
+    table is queried once for all of its fields.  Returns a list of
+    (station, interval, fields) with every field listed once.  With
+    interval='auto' each station gets the interval choose_interval picks
+    for start, end and min_points.
+
+    With fallback=True and interval='auto' the finer arrays get_data can
+    fall back to are listed after them, with all of the station's fields'''
+    plan = OrderedDict()
+    for line in fieldslist:
+        station = line['station']
+        if interval == 'auto':
+            station_interval = choose_interval(station, start, end, min_points)
+        else:
+            station_interval = interval
+        fields = plan.setdefault((station, station_interval), [])
+        if line['field'] not in fields:
+            fields.append(line['field'])
+
+    if fallback and interval == 'auto':
+        for station, station_interval in list(plan):
+            fields = plan[(station, station_interval)]
+            finer = finer_interval(station, station_interval)
+            while finer is not None:
+                plan.setdefault((station, finer), list(fields))
+                finer = finer_interval(station, finer)
+
+    return [(station, interval, fields)
+            for (station, interval), fields in plan.items()]
+
+def _fetch_plan(plan, start, end, cache=None, qc=False, fallback=False):
+    '''Runs the queries in a plan from plan_queries at the same time and
+    returns the plan with a dataframe for each.  A station whose query fails
+    or takes longer than query_timeout_secs is printed and left as empty
+    columns.
+
+    With fallback=True the fields a query comes back without are read from
+    the station's next finer array as soon as it returns, see get_data.
+    Those queries are added to the end of the plan returned'''
+    fetcher = partial(get_data_from_station, qc=qc)
+    # THE FLAGGED VALUES ARE LEFT OUT OF THE CACHED ROWS TOO
+    if cache is not None and qc:
+        cache = cache.subcache('qc')
+
+    def submit(station, interval, fields):
+        if cache is None:
+            return pool.submit(fetcher, station, fields, start, end, interval)
+        return pool.submit(cache.fetch, station, fields, start, end,
+                           interval, fetcher)
+
+    def empty(station, fields):
+        columns = ['%s_%s' % (station.lower(), field) for field in fields]
+        return pd.DataFrame(columns=columns, dtype=float,
+                            index=pd.DatetimeIndex([], name='datetime'))
+
+    # THE POOL IS NOT WAITED ON SO A HUNG QUERY CANT HOLD UP THE RESULTS
+    pool = ThreadPoolExecutor(max_workers=db_pool_size)
+    plan = list(plan)
+    dfs = [None] * len(plan)
+    pending = {submit(*query): i for i, query in enumerate(plan)}
+
+    # THE FINER QUERIES SHARE THE DEADLINE, SO A HUNG STATION CANT HOLD UP
+    # THE RESULTS ONCE FOR EACH ARRAY OR KEEP THE OTHERS FROM FALLING BACK
+    deadline = time.time() + query_timeout_secs
+    while pending:
+        done, _ = wait(pending, timeout=max(deadline - time.time(), 0),
+                       return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            i = pending.pop(future)
+            station, interval, fields = plan[i]
+            try:
+                dfs[i] = future.result()
+            except Exception as e:
+                print('Could not get data for %s at %s: %r' % (station, dtm.now(), e))
+                count('query_failures', station=station)
+                # A FAILED QUERY ISNT TRIED AGAIN ON A FINER ARRAY
+                dfs[i] = empty(station, fields)
+                continue
+
+            finer = finer_interval(station, interval) if fallback else None
+            missing = [field for field in fields
+                       if dfs[i]['%s_%s' % (station.lower(), field)].isnull().all()]
+            if finer is not None and missing:
+                dfs[i] = dfs[i].drop(['%s_%s' % (station.lower(), field)
+                                      for field in missing], axis=1)
+                plan.append((station, finer, missing))
+                dfs.append(None)
+                pending[submit(station, finer, missing)] = len(plan) - 1
+    pool.shutdown(wait=False)
+
+    for future, i in pending.items():
+        station, interval, fields = plan[i]
+        print('Could not get data for %s at %s: no results after %s seconds' % (
+                  station, dtm.now(), query_timeout_secs))
+        count('query_failures', station=station)
+        dfs[i] = empty(station, fields)
+    return plan, dfs
+
+def get_data(fieldslist, start, end, interval='1 Hour', min_points=None,
+             cache=None, qc=False):
+    '''Gets the data for every line in fieldslist, querying the station
+    tables at the same time.  A station whose query fails or takes longer
+    than query_timeout_secs is printed and left as empty columns so the rest
+    of the data still comes back.
+
+    With interval='auto' each station is read from its coarsest data array
+    that still gives min_points between start and end, fields that array
+    does not record come from the next finer array.  Data that had to
+    use a finer array only keeps the rows on the coarsest array's times so
+    the lines dont break up on the rows only the finer stations have.
+
+    Give a result_cache.ResultCache as cache to only query the rows newer
+    than the ones already cached.
+
+    Lines with an aggregate, one of min, max, mean or count, get that daily
+    aggregate from the station's rollup table instead, in a column named by
+    column_name and on the midnight starting each day.
+
+    With qc=True the values outside their Data Check range in Field_Lists.xlsx
+    are left out by the database and come back as NaN, see qc.py.  The daily
+    aggregates are made from every value.
+
+    The columns come back as float32, see compact_frame'''
+    # THE ROLLUPS ARE MADE FROM THIS MODULE'S QUERIES
+    from rollups import get_rollups
+
+    rollups = OrderedDict()
+    for line in fieldslist:
+        if line.get('aggregate'):
+            pairs = rollups.setdefault(line['station'], [])
+            if (line['field'], line['aggregate']) not in pairs:
+                pairs.append((line['field'], line['aggregate']))
+    fieldslist = [line for line in fieldslist if not line.get('aggregate')]
+
+    # THE COARSER ARRAYS DONT RECORD EVERY FIELD, FIELDS WITH NO DATA IN THE
+    # CHOSEN ARRAY ARE READ AGAIN FROM THE NEXT FINER ONE
+    plan = plan_queries(fieldslist, interval, start, end, min_points)
+    plan, dfs = _fetch_plan(plan, start, end, cache, qc,
+                            fallback=interval == 'auto')
+
+    # LINING FINER DATA UP WITH THE COARSEST INTERVAL, THE 3 AND 24 HOUR
+    # ARRAYS ARE STAMPED ON EVEN MULTIPLES OF THEIR INTERVAL FROM MIDNIGHT
+    minutes = [get_data_arrays(station).set_index('label').intervalminutes[interval]
+               for station, interval, fields in plan]
+    if len(set(minutes)) > 1:
+        coarsest = max(minutes)
+        dfs = [df[(df.index.hour * 60 + df.index.minute) % coarsest == 0]
+               for df in dfs]
+
+    for station, pairs in rollups.items():
+        dfs.append(get_rollups(station, pairs, start, end))
+
+    # CONCATENATING ALL DATAFRAMES, THE COLUMNS ARE SORTED BY NAME
+    out = pd.concat(dfs, axis=1).sort_index()
+    out = out[sorted(out.columns)]
+    return compact_frame(out)
+
+_metadata = {}
+_metadata_lock = Lock()
+
+def _cached_metadata(name, sourcefile, loader):
+    '''Returns a copy of the dataframe loader() makes from sourcefile.  The
+    dataframe is kept in memory and pickled to metadata_cachedir, both are
+    made again when the size or modification time of sourcefile changes'''
+    st = stat(sourcefile)
+    key = (st.st_size, st.st_mtime)
+
+    with _metadata_lock:
+        if name in _metadata and _metadata[name][0] == key:
+            return _metadata[name][1].copy()
+
+        picklefile = join(metadata_cachedir, '%s.pkl' % name)
+        try:
+            with open(picklefile, 'rb') as f:
+                cached_key, df = pickle.load(f)
+        except Exception:
+            cached_key, df = None, None
+
+        if cached_key != key:
+            df = loader()
+            try:
+                makedirs(metadata_cachedir, exist_ok=True)
+                with open(picklefile + '.tmp', 'wb') as f:
+                    pickle.dump((key, df), f, pickle.HIGHEST_PROTOCOL)
+                replace(picklefile + '.tmp', picklefile)
+            except OSError:
+                pass  # NOT BEING ABLE TO WRITE THE CACHE ONLY MAKES IT SLOWER
+
+        _metadata[name] = (key, df)
+        return df.copy()
 
 def get_header_info(station):
     '''This grabs the header info for a specific station and
     returns it as a pandas dataframe'''
 
-    fields = pd.read_excel(stationxlsfile, station,
-                           skiprows=0, header=1, index_col=1)
-    fields.index = fields.index.str.lower()
-    return fields
+    def read():
+        fields = pd.read_excel(stationxlsfile, station,
+                               skiprows=0, header=1, index_col=1)
+        fields.index = fields.index.str.lower()
+        return fields
+
+    return _cached_metadata('%s_header' % station, stationxlsfile, read)
 
 def get_data_arrays(station):
     '''Reads the text files in stationinfo directory and returns a dataframe of
@@ -68,8 +401,14 @@ def get_data_arrays(station):
     filename = "%s_data_arrays.txt" % station
     filepath = join(stationinfodir, filename)
 
-    data_arrs = pd.read_csv(filepath,index_col='ID')
-    return data_arrs
+    return _cached_metadata('%s_data_arrays' % station, filepath,
+                            lambda: pd.read_csv(filepath, index_col='ID'))
+
+def regular_arrays(station):
+    '''The data arrays of a station that are logged on a schedule, the 1, 3
+    and 24 Hour ones.  The Solar Noon arrays arent'''
+    da = get_data_arrays(station)
+    return da[da.label.str.match(r'^\d+ Hour$')]
 
 def get_last_date(table, arrayid):
     sql = "SELECT MAX(datetime) FROM %s WHERE arrayid=%i" % (table, arrayid)
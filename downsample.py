@@ -0,0 +1,85 @@
+'''Picks the rows of a dataframe of plot data that are worth sending to the
+browser.  Each column is downsampled on its own and the rows picked for any
+column are kept, so every column still shares one datetime index.  Rows at
+the edges of missing data are always kept so lines are not drawn across gaps.
+'''
+import numpy as np
+import pandas as pd
+
+modes = ('none', 'lttb', 'minmax')
+
+
+def lttb_indices(x, y, n_out):
+    '''Largest Triangle Three Buckets, returns the positions of the n_out
+    points of x and y that best keep the shape of the line'''
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    bucket = (n - 2) / float(n_out - 2)
+    out = np.empty(n_out, dtype=np.int64)
+    out[0], out[-1] = 0, n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start = int(i * bucket) + 1
+        end = int((i + 1) * bucket) + 1
+        nend = min(int((i + 2) * bucket) + 1, n)
+
+        # THE AVERAGE OF THE NEXT BUCKET IS THE THIRD POINT OF THE TRIANGLE
+        avg_x = x[end:nend].mean()
+        avg_y = y[end:nend].mean()
+
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) -
+                      (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + np.argmax(area)
+        out[i + 1] = a
+    return out
+
+
+def minmax_indices(x, y, n_out):
+    '''Splits x into n_out / 2 equal time bins and returns the positions of
+    the lowest and highest value in each, plus the first and last points'''
+    n = len(x)
+    if n_out >= n or n_out < 4:
+        return np.arange(n)
+
+    edges = np.linspace(x[0], x[-1], n_out // 2 + 1)
+    bins = np.clip(np.searchsorted(edges, x, side='right') - 1, 0,
+                   len(edges) - 2)
+    values = pd.Series(y)
+    grouped = values.groupby(bins)
+    return np.unique(np.concatenate([grouped.idxmin().values,
+                                     grouped.idxmax().values, [0, n - 1]]))
+
+
+def gap_edge_indices(y):
+    '''Returns the positions where a column goes from having data to missing
+    data or back, on both sides of the change'''
+    missing = np.isnan(y)
+    change = np.nonzero(missing[1:] != missing[:-1])[0]
+    return np.unique(np.concatenate([change, change + 1]))
+
+
+def downsample(df, n_out, mode='lttb'):
+    '''Returns the rows of df needed to draw each column with about n_out
+    points using mode, which is 'lttb', 'minmax' or 'none'.  Missing values
+    stay as NaN so the gaps still show up in the plots'''
+    if mode not in modes:
+        raise ValueError('Unknown downsampling mode %s' % mode)
+    if mode == 'none' or df.shape[0] <= n_out:
+        return df
+
+    pick = lttb_indices if mode == 'lttb' else minmax_indices
+    x = df.index.values.astype('datetime64[ns]').astype(np.int64) / 1e9
+
+    keep = [np.array([0, df.shape[0] - 1])]
+    for column in df.columns:
+        y = df[column].values.astype(float)
+        valid = np.nonzero(~np.isnan(y))[0]
+        if len(valid) == 0:
+            continue
+        keep.append(valid[pick(x[valid], y[valid], int(n_out))])
+        keep.append(gap_edge_indices(y))
+
+    return df.iloc[np.unique(np.concatenate(keep))]
@@ -0,0 +1,236 @@
+'''Keeps a table of the gaps in each station table, every place two rows of a
+regular (1, 3 or 24 Hour) data array are further apart than its
+intervalminutes, so the outages can be listed without reading the station
+tables.  A gap runs from the last row before it to the first row after it.
+
+upload2db updates the gaps around the rows it added.  To make the tables from
+scratch, like after a backfill, and to list the outages:
+
+python gaps.py --rebuild SBSP SASP
+python gaps.py SBSP --start 2019-01-01
+'''
+import argparse
+import numpy as np
+import pandas as pd
+from datetime import datetime as dtm, timedelta
+from config import *
+from data_access import get_data_arrays, get_last_date, plan_queries, \
+     regular_arrays
+from metrics import stage
+
+gap_columns = ['arrayid', 'gap_start', 'gap_end', 'missing']
+
+
+def gap_table(station):
+    return '%s_gaps' % tablenames[station]
+
+
+def regular_intervals(station):
+    '''The intervalminutes of the regular data arrays of a station by id,
+    the Solar Noon arrays arent logged on a schedule'''
+    return regular_arrays(station).intervalminutes
+
+
+def create_gap_sql(station, execute=False):
+    '''Returns (and prints) the SQL that creates the gap table of a station'''
+    statement = 'CREATE TABLE IF NOT EXISTS %s (\n' \
+                'arrayid integer NOT NULL,\n' \
+                'gap_start timestamp NOT NULL,\n' \
+                'gap_end timestamp NOT NULL,\n' \
+                'missing integer,\n' \
+                'PRIMARY KEY (arrayid, gap_start));' % gap_table(station)
+    print(statement)
+    if execute:
+        engine.execute(statement)
+    return statement
+
+
+def _to_datetimes(values):
+    values = pd.to_datetime(pd.Series(values))
+    if values.dt.tz is not None:
+        values = values.dt.tz_localize(None)
+    return values.values
+
+
+def find_gaps(keys, intervals):
+    '''Returns the gaps in a dataframe of arrayid and datetime columns, for
+    the arrayids in intervals, a series of their intervalminutes.  missing
+    is how many rows should have been logged in between'''
+    keys = keys[keys.arrayid.isin(intervals.index)] \
+               .sort_values(['arrayid', 'datetime'])
+    arrayids = keys.arrayid.values
+    datetimes = _to_datetimes(keys.datetime)
+    if len(arrayids) < 2:
+        return pd.DataFrame(columns=gap_columns)
+
+    # EVERY ROW AGAINST THE ONE BEFORE IT, ONLY WITHIN THE SAME ARRAY
+    minutes = np.diff(datetimes) / np.timedelta64(1, 'm')
+    interval = intervals.reindex(arrayids[1:]).values
+    gap = (arrayids[1:] == arrayids[:-1]) & (minutes > interval)
+    return pd.DataFrame({
+        'arrayid': arrayids[1:][gap],
+        'gap_start': datetimes[:-1][gap],
+        'gap_end': datetimes[1:][gap],
+        'missing': np.ceil(minutes[gap] / interval[gap]).astype(np.int64) - 1},
+        columns=gap_columns)
+
+
+def neighbours(station, bounds):
+    '''Adds the datetimes of the rows in the station table right before
+    start and right after end to bounds, a dataframe of start and end
+    indexed by arrayid, as previous and following, NaT where there are
+    none.  Each is one lookup on the (arrayid, datetime) index, all in one
+    query'''
+    table = tablenames[station]
+    parts = ["SELECT %i AS arrayid, "
+             "(SELECT MAX(datetime) FROM %s WHERE arrayid = %i AND datetime < '%s') AS previous, "
+             "(SELECT MIN(datetime) FROM %s WHERE arrayid = %i AND datetime > '%s') AS following" % (
+                 arrayid, table, arrayid, row.start.strftime(datefmt),
+                 table, arrayid, row.end.strftime(datefmt))
+             for arrayid, row in bounds.iterrows()]
+    rows = engine.execute(' UNION ALL '.join(parts)).fetchall()
+    found = pd.DataFrame(rows, columns=['arrayid', 'previous', 'following']) \
+              .set_index('arrayid')
+    bounds = bounds.copy()
+    bounds['previous'] = _to_datetimes(found.previous.reindex(bounds.index))
+    bounds['following'] = _to_datetimes(found.following.reindex(bounds.index))
+    return bounds
+
+
+def frame_bounds(station, rawfile):
+    '''The first and last datetime of each regular data array in a rawfile
+    indexed by arrayid and datetime'''
+    keys = rawfile.index.to_frame(index=False)
+    keys = keys[keys.arrayid.isin(regular_intervals(station).index)]
+    bounds = keys.groupby('arrayid').datetime
+    return pd.concat([bounds.min(), bounds.max()], axis=1,
+                     keys=['start', 'end'])
+
+
+def update_gaps(station, bounds):
+    '''Finds the gaps again from the row before start to the row after end
+    for each arrayid in bounds, a dataframe of start and end indexed by
+    arrayid, and replaces the ones in the table over that time'''
+    with stage('gaps', station=station) as m:
+        intervals = regular_intervals(station)
+        bounds = bounds[bounds.index.isin(intervals.index)]
+        if bounds.shape[0] == 0:
+            return pd.DataFrame(columns=gap_columns)
+        bounds = neighbours(station, bounds)
+        low = bounds.previous.fillna(bounds.start)
+        high = bounds.following.fillna(bounds.end)
+
+        clauses = ["(arrayid = %i AND datetime BETWEEN '%s' AND '%s')" % (
+                       arrayid, low[arrayid].strftime(datefmt),
+                       high[arrayid].strftime(datefmt))
+                   for arrayid in bounds.index]
+        rows = engine.execute('SELECT arrayid, datetime FROM %s WHERE %s' % (
+                                  tablenames[station], ' OR '.join(clauses))).fetchall()
+        gaps = find_gaps(pd.DataFrame(rows, columns=['arrayid', 'datetime']),
+                         intervals)
+
+        if not engine.has_table(gap_table(station)):
+            create_gap_sql(station, execute=True)
+        # A GAP THAT NEW ROWS FALL IN RUNS FROM low TO high
+        with engine.begin() as conn:
+            for arrayid in bounds.index:
+                conn.execute("DELETE FROM %s WHERE arrayid = %i AND "
+                             "gap_start >= '%s' AND gap_end <= '%s'" % (
+                                 gap_table(station), arrayid,
+                                 low[arrayid].strftime(datefmt),
+                                 high[arrayid].strftime(datefmt)))
+            gaps.to_sql(gap_table(station), conn, if_exists='append',
+                        index=False)
+        m['gaps'] = gaps.shape[0]
+    return gaps
+
+
+def update_gaps_for(station, rawfile):
+    '''Updates the gaps around the rows of a rawfile that was uploaded'''
+    if rawfile.shape[0]:
+        update_gaps(station, frame_bounds(station, rawfile))
+
+
+def rebuild_gaps(station):
+    '''Makes the gap table of a station from scratch'''
+    engine.execute('DROP TABLE IF EXISTS %s' % gap_table(station))
+    create_gap_sql(station, execute=True)
+
+    for arrayid in regular_intervals(station).index:
+        first, last = engine.execute(
+            'SELECT MIN(datetime), MAX(datetime) FROM %s WHERE arrayid = %i' % (
+                tablenames[station], arrayid)).fetchall()[0]
+        if first is None:
+            continue
+        bounds = pd.DataFrame({'start': _to_datetimes([first]),
+                               'end': _to_datetimes([last])},
+                              index=pd.Index([arrayid], name='arrayid'))
+        gaps = update_gaps(station, bounds)
+        print('%s arrayid %i has %i gaps' % (station, arrayid, gaps.shape[0]))
+
+
+def get_gaps(station, start, end, arrayids=None):
+    '''Returns the gaps of a station that overlap start to end, nothing if
+    the gap table isnt there yet'''
+    if not engine.has_table(gap_table(station)):
+        return pd.DataFrame(columns=gap_columns)
+    sql = "SELECT %s FROM %s WHERE gap_end >= '%s' AND gap_start <= '%s'" % (
+              ', '.join(gap_columns), gap_table(station),
+              pd.Timestamp(start).strftime(datefmt),
+              pd.Timestamp(end).strftime(datefmt))
+    if arrayids is not None:
+        sql += ' AND arrayid IN (%s)' % ', '.join('%i' % a for a in arrayids)
+    gaps = pd.read_sql_query(sql + ' ORDER BY arrayid, gap_start', engine)
+    gaps['gap_start'] = _to_datetimes(gaps.gap_start)
+    gaps['gap_end'] = _to_datetimes(gaps.gap_end)
+    return gaps
+
+
+def report_outages(fieldslist, start, end, interval='1 Hour', min_points=None):
+    '''Prints the outages between start and end of the data arrays the lines
+    in fieldslist are read from, see plan_queries, along with ones that
+    havent logged since more than an interval before end.  With an 'auto'
+    interval the finer arrays get_data can fall back to are included.
+    Returns the lines printed'''
+    lines = []
+    for station, station_interval, fields in plan_queries(
+            fieldslist, interval, start, end, min_points, fallback=True):
+        da = get_data_arrays(station)
+        arrayid = da[da.label == station_interval].index[0]
+        for _, gap in get_gaps(station, start, end, [arrayid]).iterrows():
+            lines.append('%s %s: no data from %s to %s, %i rows missing' % (
+                             station, station_interval, gap.gap_start,
+                             gap.gap_end, gap.missing))
+
+        last = get_last_date(tablenames[station], arrayid)[0][0]
+        minutes = da.intervalminutes[arrayid]
+        if last is not None:
+            last = pd.Timestamp(_to_datetimes([last])[0])
+            if pd.Timestamp(end) - last > timedelta(minutes=2 * int(minutes)):
+                lines.append('%s %s: no data since %s' % (
+                                 station, station_interval, last))
+    for line in lines:
+        print(line)
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('stations', nargs='*', default=sorted(tablenames),
+                        help='the stations to look at, all of them by default')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='find the gaps again in every row of the tables')
+    parser.add_argument('--start', default='1900-01-01',
+                        help='list the gaps after this date')
+    args = parser.parse_args()
+
+    for station in args.stations:
+        if args.rebuild:
+            rebuild_gaps(station)
+        gaps = get_gaps(station, args.start, dtm.now())
+        da = get_data_arrays(station)
+        for _, gap in gaps.iterrows():
+            print('%s %s: no data from %s to %s, %i rows missing' % (
+                      station, da.label[gap.arrayid], gap.gap_start,
+                      gap.gap_end, gap.missing))
@@ -0,0 +1,111 @@
+'''Records how long each stage of the uploads and plots takes, along with the
+rows, bytes and retries, so a slow hourly cycle can be traced to the stage
+that got slower.  Every stage is appended as a json line to metrics_logfile,
+and write_textfile writes the totals in the Prometheus text format for the
+node_exporter textfile collector.
+
+    with stage('upload2db', station='SBSP') as m:
+        ...
+        m['rows'] = nrows
+'''
+import json
+import time
+from os import replace, getpid
+from os.path import join
+from threading import Lock
+from contextlib import contextmanager
+from datetime import datetime as dtm
+from config import *
+
+_lock = Lock()
+_counters = {}
+_stages = {}
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def count(name, value=1, **labels):
+    '''Adds value to the counter name with the labels'''
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def log_event(record):
+    '''Appends a record to metrics_logfile as one json line'''
+    record = dict(record, time=dtm.now().isoformat(), pid=getpid())
+    try:
+        with _lock, open(metrics_logfile, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+    except OSError:
+        pass  # NOT BEING ABLE TO LOG SHOULDNT STOP AN UPLOAD
+
+
+@contextmanager
+def stage(name, **labels):
+    '''Times the block inside it as stage name.  It yields a dict, numbers put
+    in it like rows or bytes are logged with the time and added to the
+    counters csas_<key>_total with the stage and labels'''
+    extra = {}
+    ok = False
+    start = time.perf_counter()
+    try:
+        yield extra
+        ok = True
+    finally:
+        secs = time.perf_counter() - start
+        with _lock:
+            key = _key(name, labels)
+            runs, total, _ = _stages.get(key, (0, 0., 0.))
+            _stages[key] = (runs + 1, total + secs, secs)
+        if not ok:
+            count('stage_failures', stage=name, **labels)
+        for k, v in extra.items():
+            if isinstance(v, (int, float)):
+                count(k, v, stage=name, **labels)
+        log_event(dict(labels, stage=name, secs=round(secs, 6), ok=ok, **extra))
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                    for k, v in labels)
+
+
+def textfile_lines():
+    '''The stages and counters in the Prometheus text format'''
+    with _lock:
+        stages = dict(_stages)
+        counters = dict(_counters)
+
+    lines = []
+    for metric, kind, column in (('csas_stage_runs_total', 'counter', 0),
+                                 ('csas_stage_seconds_total', 'counter', 1),
+                                 ('csas_stage_last_seconds', 'gauge', 2)):
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for (name, labels), values in sorted(stages.items()):
+            lines.append('%s{%s} %s' % (metric, _labels(sorted((('stage', name),) + labels)),
+                                        repr(float(values[column]))))
+
+    names = sorted(set(name for name, _ in counters))
+    for name in names:
+        metric = 'csas_%s_total' % name
+        lines.append('# TYPE %s counter' % metric)
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append('%s{%s} %s' % (metric, _labels(labels),
+                                            repr(float(value))))
+    return lines
+
+
+def write_textfile(job):
+    '''Writes the metrics to csas_<job>.prom in metrics_textfile_dir, if it is
+    set.  The file is replaced in one go so the collector never reads half of
+    it'''
+    if not metrics_textfile_dir:
+        return
+    path = join(metrics_textfile_dir, 'csas_%s.prom' % job)
+    with open(path + '.tmp', 'w') as f:
+        f.write('\n'.join(textfile_lines()) + '\n')
+    replace(path + '.tmp', path)
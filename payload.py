@@ -0,0 +1,131 @@
+'''Writes the plot data to a binary file next to the html instead of inside it,
+so browsers and the web server can cache the page and the data separately.
+The file starts with the length of a json header as a uint32, then the
+header with the index name, the columns and the number of rows, padded
+with spaces to a multiple of 8 bytes.  After it come the datetimes as
+float64 milliseconds and each column as float32, all little endian.  A
+small script added to the page reads it into the ColumnDataSource when the
+page opens.
+
+The page only holds the name of the file, so it doesnt change when the
+data does and a page always reads a file that describes itself.  The data
+file has to go up before the page when a new column is added, see
+plotter.upload_rendered.
+
+Browsers wont fetch the data from a file:// page, to look at one locally run
+python -m http.server in the output directory and open it from there.
+'''
+import json
+import struct
+import numpy as np
+import pandas as pd
+from os.path import basename
+
+# THE END OF THE NAME OF THE DATA FILE NEXT TO EACH PAGE
+payload_suffix = '_data.bin'
+
+
+def write_payload(df, path):
+    '''Writes df to path as typed arrays and returns the manifest the page
+    needs to find it'''
+    index = df.index.values.astype('datetime64[ms]').astype(np.int64)
+    arrays = [index.astype('<f8')] + \
+             [df[column].values.astype('<f4') for column in df.columns]
+
+    header = json.dumps({'index': df.index.name or 'index',
+                         'columns': [str(column) for column in df.columns],
+                         'length': df.shape[0]}).encode()
+    # THE FLOAT64 DATETIMES HAVE TO START ON A MULTIPLE OF 8 BYTES
+    header += b' ' * (-(4 + len(header)) % 8)
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for array in arrays:
+            f.write(array.tobytes())
+    return {'url': basename(path)}
+
+
+def read_payload(path):
+    '''Reads a file from write_payload back into a dataframe'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    length, = struct.unpack('<I', data[:4])
+    header = json.loads(data[4:4 + length].decode())
+    n, offset = header['length'], 4 + length
+
+    index = np.frombuffer(data, '<f8', n, offset)
+    offset += 8 * n
+    columns = []
+    for column in header['columns']:
+        columns.append(np.frombuffer(data, '<f4', n, offset))
+        offset += 4 * n
+    index = pd.DatetimeIndex(index.astype(np.int64).astype('datetime64[ms]'),
+                             name=header['index'])
+    return pd.DataFrame(dict(zip(header['columns'], columns)), index=index,
+                        columns=header['columns'])
+
+
+def empty_source_data(df):
+    '''The data for a ColumnDataSource with the columns of df and no rows'''
+    data = dict((column, []) for column in df.columns)
+    data[df.index.name or 'index'] = []
+    return data
+
+
+loader = '''
+<script type="text/javascript">
+(function() {
+  var manifest = %s;
+  function load() {
+    // WAITING FOR BOKEH TO FINISH BUILDING THE PAGE
+    var source = null;
+    if (typeof Bokeh !== 'undefined' && Bokeh.documents.length > 0) {
+      source = Bokeh.documents[0].get_model_by_name(manifest.source);
+    }
+    if (source === null) {
+      setTimeout(load, 50);
+      return;
+    }
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', manifest.url);
+    // THE FILE KEEPS ITS NAME, THE SERVER IS ASKED EACH TIME IF IT CHANGED
+    xhr.setRequestHeader('Cache-Control', 'no-cache');
+    xhr.responseType = 'arraybuffer';
+    xhr.onload = function() {
+      var buffer = xhr.response;
+      var length = new DataView(buffer).getUint32(0, true);
+      var header = JSON.parse(String.fromCharCode.apply(
+                       null, new Uint8Array(buffer, 4, length)));
+      var n = header.length, offset = 4 + length, data = {};
+      data[header.index] = new Float64Array(buffer, offset, n);
+      offset += 8 * n;
+      header.columns.forEach(function(column) {
+        data[column] = new Float32Array(buffer, offset, n);
+        offset += 4 * n;
+      });
+      source.data = data;
+    };
+    xhr.send();
+  }
+  load();
+})();
+</script>
+'''
+
+
+def add_loader(htmlfile, manifest, source_name):
+    '''Adds the script that loads the payload into the source named
+    source_name to the end of the saved html file'''
+    manifest = dict(manifest, source=source_name)
+    with open(htmlfile, 'r') as f:
+        html = f.read()
+
+    script = loader % json.dumps(manifest)
+    if '</body>' in html:
+        html = html.replace('</body>', script + '</body>', 1)
+    else:
+        html = html + script
+
+    with open(htmlfile, 'w') as f:
+        f.write(html)
@@ -23,6 +23,15 @@ import argparse
 import codecs
 import paramiko
 from sftp import *
+from downsample import downsample, modes as downsample_modes
+from result_cache import ResultCache
+from payload import write_payload, empty_source_data, add_loader, payload_suffix
+from os.path import basename
+import posixpath
+from os.path import getsize, splitext
+from hashlib import sha256
+from metrics import stage, count, write_textfile
+from gaps import report_outages
 
 
 ## STUFF YOU MIGHT WANT TO CHANGE:
@@ -32,6 +41,209 @@ plot_width = 800
 plot_height = 300
 
 
+colorslist = {
+'PTSP':'#e41a1c',
+'SBSG':'#377eb8',
+'SBSP':'#4daf4a',
+'SASP':'#984ea3'}
+
+
+def read_template(jsonfile):
+    '''Reads a json template file, some of them are saved with a byte
+    order mark'''
+    try:
+        with open(jsonfile,'r') as f:
+            return json.load(f)
+    except Exception:
+        with codecs.open(jsonfile, 'r', 'utf-8-sig') as f:
+            return json.load(f)
+
+def template_lines(template):
+    '''Returns every line in the template, these are what get_data takes'''
+    querydata = []
+    for templ in template:
+        for plot in templ['plots']:
+            for line in plot['lines']:
+                querydata.append(line)
+    return querydata
+
+def make_layout(template, source, xrange, has_data=None):
+    '''Makes the figures for every page and plot in the template, as tabs if
+    there is more than one page.  source is the ColumnDataSource every line
+    reads from, or a dict of one for each fieldname like sasp_loair_avg_c.
+    Lines for which has_data(fieldname) is False are left out'''
+    # SETTING VARIOUS OPTIONS FOR THE PLOTTERS
+    options = {'width':plot_width,'height':plot_height,'tools':'xwheel_zoom,xpan,crosshair',
+               'x_axis_type':"datetime",'x_range':xrange, 'x_axis_type':'datetime'}
+
+    # IF ONLY ONE PAGE OF DATA IS LISTED IN THE JSON THEN TABS WILL NOT BE CREATED
+    should_i_make_tabs = True if len(template) > 1 else False
+    if should_i_make_tabs:
+        tabs = []
+
+    # LOOPING THROUGH EACH OF THE TABS
+    for tab in template:
+        plots = []
+        # LOOPING THROUGH EACH OF THE PLOTS
+        for plot in tab['plots']:
+            yrange = Range1d(start=plot['yrange'][0],   # SETTING THE Y LIMITS FOR THE AXES
+                             end=plot['yrange'][1])
+
+            f = figure(title=plot['axes_title'],   # MAKING THE FIGURE
+                       y_range=yrange,
+                       **options)
+
+            # LOOPING THROUGH EACH LINE FOR THIS AXES AND PLOTTING IT
+            for line in plot['lines']:
+
+                # GETTING THE FIELDNAME NEEDED TO PULL THE CORRECT DATA FROM THE DATA SOURCE
+                station = line['station']
+
+                # SETTING THE COLOR AND LEGEND LABEL
+                color = colorslist[station] if not 'color' in line else line['color']
+                label = station if not 'label' in line else line['label']
+
+                fieldname = column_name(line)
+
+                # IF ALL THE DATA IS MISSING DON'T PLOT THIS LINE
+                if has_data is not None and not has_data(fieldname): continue
+
+                # PLOTTING THE LINE
+                f.line('datetime', fieldname,
+                       legend=label,
+                       source=source[fieldname] if isinstance(source, dict) else source,
+                       color=color)
+
+            f.legend.location = legend_location
+            f.legend.label_text_font_size = legend_font_size
+            plots.append(f)    # APPENDING THIS PLOT TO A LIST OF PLOTS
+
+        # STACKING ALL OF THESE PLOTS INTO A SINGLE COLUMN OF PLOTS
+        all = column(plots)
+        if should_i_make_tabs:
+            tab = Panel(child=all, title=tab["page_name"])
+            tabs.append(tab)
+
+    if should_i_make_tabs:
+        all = Tabs(tabs=tabs)
+    return all
+
+def check_arguments(output, jsonfile, tdelta_days, tdelta_days_showing):
+    '''Raises a RuntimeError if the files or days for a plot dont make sense'''
+    if not fileexists(jsonfile):
+        raise RuntimeError('Could not find file %s' % jsonfile)
+
+    if not fileexists(dirname(output)):
+        raise RuntimeError('Invalid path for %s' % output)
+
+    if tdelta_days < tdelta_days_showing:
+        raise RuntimeError('The number of days of data is less than the number' +
+        'of days showing when loaded, did you switch them?')
+
+    if tdelta_days < 1: raise RuntimeError ('tdelta_days must be >= 1')
+    if tdelta_days_showing < 1: raise RuntimeError ('tdelta_days_showing must be >= 1')
+
+def plot_state(jsonfile, arguments, querydata, interval, start, end, n_points):
+    '''What a plot is made from, the template, the arguments and the last row
+    of each data array it reads, along with the finer arrays an 'auto'
+    interval can fall back to.  The arguments are hashed so a password isnt
+    written to the state file'''
+    with open(jsonfile, 'rb') as f:
+        template_hash = sha256(f.read()).hexdigest()
+    arguments = sha256(json.dumps(arguments, sort_keys=True).encode()).hexdigest()
+    last_dates = {}
+    for station, station_interval, fields in plan_queries(querydata, interval, start,
+                                                          end, n_points, fallback=True):
+        da = get_data_arrays(station)
+        arrayid = da[da.label == station_interval].index[0]
+        last_dates['%s %s' % (station, arrayid)] = \
+            str(get_last_date(tablenames[station], arrayid)[0][0])
+    return {'template': template_hash, 'arguments': arguments,
+            'last_dates': last_dates}
+
+def state_unchanged(output, state):
+    '''True if output was already made from the same state'''
+    statefile = splitext(output)[0] + '_state.json'
+    if not fileexists(output) or not fileexists(statefile):
+        return False
+    with open(statefile, 'r') as f:
+        return json.load(f) == state
+
+def save_state(output, state):
+    with open(splitext(output)[0] + '_state.json', 'w') as f:
+        json.dump(state, f)
+
+def render(template, df, output, start_initial, end, n_points,
+           downsample_mode='none', external_data=False):
+    '''Saves the plots for the template with the data in df to output and
+    returns the files written, the html first'''
+    if fileexists(output):
+        remove(output)
+    output_file(output)
+
+    with stage('render', output=basename(output)) as m:
+        rows_before = df.shape[0]
+        if downsample_mode != 'none':
+            df = downsample(df, n_points, downsample_mode)
+
+        if external_data:
+            payloadfile = splitext(output)[0] + payload_suffix
+            manifest = write_payload(df, payloadfile)
+            source = ColumnDataSource(data=empty_source_data(df), name='csas_data')
+        else:
+            source = ColumnDataSource(df)
+
+        # SETTING THE XLIMITS FOR THE PLOTTERS AND MAKING THEM
+        xrange = Range1d(start=start_initial, end=end)# bounds=[start,end],
+        all = make_layout(template, source, xrange,
+                          lambda fieldname: not df[fieldname].isnull().all())
+        # DONE!!
+        save(all)
+        files = [output]
+        print('Saved %s, %i bytes' % (output, getsize(output)))
+        if external_data:
+            add_loader(output, manifest, 'csas_data')
+            print('Saved %s, %i bytes' % (payloadfile, getsize(payloadfile)))
+            files.append(payloadfile)
+        m['rows'] = df.shape[0]
+        m['bytes_written'] = sum(getsize(f) for f in files)
+
+        if downsample_mode != 'none':
+            # THE FILE THE DATA IS IN WITHOUT DOWNSAMPLING, FROM WHAT EACH ROW
+            # TAKES UP IN IT RATHER THAN SAVING THE PAGE AGAIN WITH EVERY ROW
+            if external_data:
+                datafile, row_bytes = payloadfile, 8 + 4 * df.shape[1]
+            else:
+                datafile = output
+                row_bytes = len(source.to_json_string(include_defaults=False)) / \
+                            float(max(df.shape[0], 1))
+            size_before = getsize(datafile) + row_bytes * (rows_before - df.shape[0])
+            print('Downsampled with %s from %i to %i rows, %s from about %i to %i bytes' % (
+                  downsample_mode, rows_before, df.shape[0], basename(datafile),
+                  size_before, getsize(datafile)))
+            m['rows_before_downsampling'] = rows_before
+            m['bytes_before_downsampling'] = int(size_before)
+    return files
+
+def remote_paths(files, remote_filepath):
+    '''Pairs the files render wrote with where they go on the server, the
+    html to remote_filepath and the data next to it so the page can find it'''
+    return [(files[0], remote_filepath)] + \
+           [(localfile, posixpath.join(posixpath.dirname(remote_filepath),
+                                       basename(localfile)))
+            for localfile in files[1:]]
+
+def upload_rendered(sftp, uploads):
+    '''Uploads the (local_path, remote_path) pairs from remote_paths, every
+    data file before any of the pages so a page never goes up ahead of the
+    data it reads'''
+    data = [pair for pair in uploads if pair[0].endswith(payload_suffix)]
+    pages = [pair for pair in uploads if not pair[0].endswith(payload_suffix)]
+    for paths in (data, pages):
+        if paths:
+            sftp.upload_many(paths)
+
+
 # PARSING COMMAND LINE ARGUEMENTS
 parser = argparse.ArgumentParser(description="""
 This script needs to be executed on a regular basis to create the plots and it can also upload the plot 
@@ -83,133 +295,99 @@ parser.add_argument('--remote_filepath',
 		    'the file on the other server',
                     default=False,
                     type=str)
-
-# sftp = SftpClient(remote_ip,22,remote_username,remote_password)
-
-args = parser.parse_args()
-output = args.output
-jsonfile = args.jsonfile
-tdelta_days = args.tdelta_days
-tdelta_days_showing = args.tdelta_days_showing
-
-
-# SANITY CHECKS
-if not fileexists(jsonfile):
-    raise RuntimeError('Could not find file %s' % jsonfile)
-
-if not fileexists(dirname(output)):
-    raise RuntimeError('Invalid path for %s' % output)
-
-if fileexists(output):
-    remove(output)
-
-if tdelta_days < tdelta_days_showing:
-    raise RuntimeError('The number of days of data is less than the number' +
-    'of days showing when loaded, did you switch them?')
-
-if tdelta_days < 1: raise RuntimeError ('tdelta_days must be >= 1')
-if tdelta_days_showing < 1: raise RuntimeError ('tdelta_days_showing must be >= 1')
-
-# if fileexists(output):
-#     remove(output)
-output_file(output)
-
-colorslist = {
-'PTSP':'#e41a1c',
-'SBSG':'#377eb8',
-'SBSP':'#4daf4a',
-'SASP':'#984ea3'}
-
-# READING THE TEMPLATE JSON FILE
-try:
-    with open(jsonfile,'r') as f:
-        template = json.load(f)
-except Exception:
-    with codecs.open(jsonfile, 'r', 'utf-8-sig') as f:
-        template = json.load(f)
-
-
-
-#ORGANIZING JSON TEMPLATE DATA
-querydata = []
-for templ in template:
-    for plot in templ['plots']:
-        for line in plot['lines']:
-            querydata.append(line)
-
-
-# SETTING TIME RANGE
-end = dtm.now()
-start = end + timedelta(days=-tdelta_days)
-start_initial = end + timedelta(days=-tdelta_days_showing)
-
-# ASSEMBLING THE DATA INTO A DATASOURCE FOR THE PLOTTER
-df = get_data(querydata,start,end)
-source = ColumnDataSource(df)
-
-# SETTING VARIOUS OPTIONS AND XLIMITS FOR THE PLOTTERS
-xrange = Range1d(start=start_initial, end=end)# bounds=[start,end],
-options = {'width':plot_width,'height':plot_height,'tools':'xwheel_zoom,xpan,crosshair',
-           'x_axis_type':"datetime",'x_range':xrange, 'x_axis_type':'datetime'}
-
-# IF ONLY ONE PAGE OF DATA IS LISTED IN THE JSON THEN TABS WILL NOT BE CREATED
-should_i_make_tabs = True if len(template) > 1 else False
-if should_i_make_tabs:
-    tabs = []
-
-# LOOPING THROUGH EACH OF THE TABS
-for tab in template:
-    plots = []
-    # LOOPING THROUGH EACH OF THE PLOTS
-    for plot in tab['plots']:
-        # print(plot['axes_title'], plot['yrange'])
-        yrange = Range1d(start=plot['yrange'][0],   # SETTING THE Y LIMITS FOR THE AXES
-                         end=plot['yrange'][1])
-
-        f = figure(title=plot['axes_title'],   # MAKING THE FIGURE
-                   y_range=yrange,
-                   **options)
-
-        # LOOPING THROUGH EACH LINE FOR THIS AXES AND PLOTTING IT
-        for line in plot['lines']:
-
-            # GETTING THE FIELDNAME NEEDED TO PULL THE CORRECT DATA FROM THE DATA SOURCE
-            station = line['station']
-
-            # SETTING THE COLOR AND LEGEND LABEL
-            color = colorslist[station] if not 'color' in line else line['color']
-            label = station if not 'label' in line else line['label']
-
-            fieldname = "%s_%s" % (station.lower(), line['field'])
-            # print('    ', line['field'], fieldname)
-            # print('        ',color,label)
-
-            # IF ALL THE DATA IS MISSING DON'T PLOT THIS LINE
-            if df[fieldname].isnull().all(): continue
-
-            # PLOTTING THE LINE
-            f.line('datetime', fieldname,
-                   legend=label,
-                   source=source,
-                   color=color)
-
-        f.legend.location = legend_location
-        f.legend.label_text_font_size = legend_font_size
-        plots.append(f)    # APPENDING THIS PLOT TO A LIST OF PLOTS
-
-    # STACKING ALL OF THESE PLOTS INTO A SINGLE COLUMN OF PLOTS
-    all = column(plots)
-    if should_i_make_tabs:
-        tab = Panel(child=all, title=tab["page_name"])
-        tabs.append(tab)
-
-if should_i_make_tabs:
-    all = Tabs(tabs=tabs)
-# DONE!!
-save(all)
-#show(all)
-if args.remote_ip:
-    sftp = SftpClient(args.remote_ip,22,args.remote_username,args.remote_password)
-    sftp.upload(output, args.remote_filepath)
-    sftp.close()
-
+parser.add_argument('--downsample',
+                    help='Reduce the number of points sent to the browser with ' +
+                    'lttb (largest triangle three buckets) or minmax (the ' +
+                    'lowest and highest value in each time bin)',
+                    choices=downsample_modes,
+                    default='none',
+                    type=str)
+parser.add_argument('--points_per_pixel',
+                    help='With --downsample, about how many points to keep per ' +
+                    'pixel of plot width for the days showing on page load',
+                    default=2,
+                    type=float)
+parser.add_argument('--auto_resolution',
+                    help='Read each station from its coarsest data array (1, 3 ' +
+                    'or 24 hour) that still gives points_per_pixel points per ' +
+                    'pixel, instead of always reading the hourly data',
+                    action='store_true')
+parser.add_argument('--cache_dir',
+                    help='Keep the data in this directory between runs so only ' +
+                    'the rows added since the last run are queried',
+                    default=False,
+                    type=str)
+parser.add_argument('--force',
+                    help='Make and upload the plots even if there is no new ' +
+                    'data and the template and arguments have not changed ' +
+                    'since the last run',
+                    action='store_true')
+parser.add_argument('--external_data',
+                    help='Write the data to a binary file next to the html file, ' +
+                    'which the page loads when it opens, instead of inside the ' +
+                    'html.  The page then has to be opened from a web server',
+                    action='store_true')
+parser.add_argument('--qc',
+                    help='Leave out the values outside the Data Check range of ' +
+                    'their field in Field_Lists.xlsx',
+                    action='store_true')
+
+if __name__ == '__main__':
+    # sftp = SftpClient(remote_ip,22,remote_username,remote_password)
+
+    args = parser.parse_args()
+    output = args.output
+    jsonfile = args.jsonfile
+    tdelta_days = args.tdelta_days
+    tdelta_days_showing = args.tdelta_days_showing
+
+
+    # SANITY CHECKS
+    check_arguments(output, jsonfile, tdelta_days, tdelta_days_showing)
+
+    # READING THE TEMPLATE JSON FILE
+    template = read_template(jsonfile)
+
+    #ORGANIZING JSON TEMPLATE DATA
+    querydata = template_lines(template)
+
+
+    # SETTING TIME RANGE
+    end = dtm.now()
+    start = end + timedelta(days=-tdelta_days)
+    start_initial = end + timedelta(days=-tdelta_days_showing)
+
+    # ABOUT points_per_pixel POINTS PER PIXEL FOR THE DAYS SHOWING ON PAGE LOAD,
+    # THE REST OF THE DAYS GET THE SAME DENSITY
+    n_points = plot_width * args.points_per_pixel * tdelta_days / tdelta_days_showing
+    interval = 'auto' if args.auto_resolution else '1 Hour'
+
+    # CHECKING IF ANYTHING CHANGED SINCE THE LAST RUN, THE LAST ROW OF EACH DATA
+    # ARRAY WE PLOT, THE TEMPLATE AND THE ARGUMENTS (BESIDES --force)
+    arguments = dict((k, v) for k, v in vars(args).items() if k != 'force')
+    state = plot_state(jsonfile, arguments, querydata, interval, start, end, n_points)
+    if not args.force and state_unchanged(output, state):
+        print('Nothing changed since the last run, not remaking %s' % output)
+        count('plots_skipped')
+        write_textfile('plotter')
+        sys.exit(0)
+
+    # ASSEMBLING THE DATA INTO A DATASOURCE FOR THE PLOTTER
+    cache = ResultCache(args.cache_dir, result_cache_max_days) if args.cache_dir else None
+    with stage('get_data') as m:
+        df = get_data(querydata, start, end, interval, min_points=n_points,
+                      cache=cache, qc=args.qc)
+        m['rows'] = df.shape[0]
+    report_outages(querydata, start, end, interval, n_points)
+
+    files = render(template, df, output, start_initial, end, n_points,
+                   args.downsample, args.external_data)
+    #show(all)
+    if args.remote_ip:
+        sftp = SftpClient(args.remote_ip,22,args.remote_username,args.remote_password)
+        upload_rendered(sftp, remote_paths(files, args.remote_filepath))
+        sftp.close()
+
+    # REMEMBERING WHAT THIS RUN WAS MADE FROM SO THE NEXT ONE CAN SKIP IF NOTHING CHANGED
+    save_state(output, state)
+    write_textfile('plotter')
@@ -0,0 +1,147 @@
+'''Checks the values of every field against the Data Check range in
+Field_Lists.xlsx as the rows are loaded.  Each field with a range gets a bit
+of the qc_flags column, which is set on the rows where the field is outside
+its range, so get_data(..., qc=True) can have the database leave those
+values out.  Missing values are never flagged, and neither are the rows of
+the Solar Noon arrays, which keep other values in the same columns.
+
+The bits follow the order of the fields in Field_Lists.xlsx, with albedo
+after them, so adding a range to a field in the middle moves the bits of the
+fields after it.  Flag the rows already in the database again afterwards:
+
+python qc.py SBSP SASP --flag_existing
+'''
+import argparse
+import re
+import numpy as np
+import pandas as pd
+from config import *
+from data_access import get_header_info, regular_arrays, float32_rtol
+from metrics import stage
+
+# A MINUS SIGN ONLY COUNTS IF IT DOESNT FOLLOW A NUMBER, SO 0-100 IS 0 AND 100
+_number = re.compile(r'(?<![\d.])[-+]?\d+(?:\.\d+)?')
+# bigint IS SIGNED
+max_checks = 63
+
+
+def parse_data_check(text):
+    '''Returns the (low, high) of a Data Check like '-60ºC — +50ºC', '0-100%',
+    '12.2 - 15.0 V', '0,1' or '>12', or None if there is no range in it'''
+    if not isinstance(text, str):
+        return None
+    numbers = [float(n) for n in _number.findall(text)]
+    if text.strip().startswith('>') and numbers:
+        return numbers[0], np.inf
+    if text.strip().startswith('<') and numbers:
+        return -np.inf, numbers[0]
+    # THE REST ARE UNITS, LIKE THE 2 OF W/m2
+    if len(numbers) < 2:
+        return None
+    return min(numbers[:2]), max(numbers[:2])
+
+
+def qc_checks(station):
+    '''The fields of a station that have a Data Check range, with their low
+    and high values and the bit they set in qc_flags'''
+    header = get_header_info(station)
+    checks = [(field, text) for field, text in header['Data Check'].items()]
+    checks.append((albedo_info['fieldname'], albedo_info['Data Check']))
+
+    rows = []
+    for field, text in checks:
+        bounds = parse_data_check(text)
+        if bounds is not None:
+            rows.append((field, bounds[0], bounds[1], len(rows)))
+    if len(rows) > max_checks:
+        raise ValueError('%s has %i Data Check ranges, qc_flags only has '
+                         'room for %i' % (station, len(rows), max_checks))
+    return pd.DataFrame(rows, columns=['field', 'low', 'high', 'bit']) \
+             .set_index('field')
+
+
+def widened(checks, rtol=float32_rtol):
+    '''The low and high of checks moved out by rtol of their size.  The
+    values are kept as float32 in the frames and as real in the database, so
+    a reading of exactly 12.2 comes back as 12.1999998 and would be flagged
+    against a low of 12.2 without it'''
+    low = checks.low.values.astype(np.float64)
+    high = checks.high.values.astype(np.float64)
+    with np.errstate(invalid='ignore'):
+        return low - rtol * np.abs(low), high + rtol * np.abs(high)
+
+
+def checked_arrays(station):
+    '''The ids of the regular (1, 3 or 24 Hour) data arrays of a station,
+    the ones the checks apply to'''
+    return list(regular_arrays(station).index)
+
+
+def qc_flags(df, checks, arrayids=None):
+    '''Returns the qc_flags of every row of df, indexed by arrayid and
+    datetime, for the checks from qc_checks, checking all of the fields at
+    once.  Only the rows of arrayids are checked if it is given.  Fields
+    that arent columns of df are left unflagged'''
+    checks = checks[checks.index.isin(df.columns)]
+    values = df[checks.index].values
+    low, high = widened(checks)
+    with np.errstate(invalid='ignore'):
+        bad = (values < low) | (values > high)
+    if arrayids is not None:
+        bad &= df.index.get_level_values('arrayid').isin(arrayids)[:, None]
+    bits = np.left_shift(np.int64(1), checks.bit.values.astype(np.int64))
+    return bad.astype(np.int64).dot(bits)
+
+
+def checked_column_sql(station, field, checks=None):
+    '''The SQL for a field that is NULL on the rows where it was flagged.
+    Rows loaded before there were flags have a NULL qc_flags and are kept'''
+    if checks is None:
+        checks = qc_checks(station)
+    if field not in checks.index:
+        return field
+    return 'CASE WHEN (COALESCE(qc_flags, 0) & %i) = 0 THEN %s END' % (
+               1 << int(checks.bit[field]), field)
+
+
+def flag_existing_rows_sql(station, execute=False):
+    '''Returns (and prints) the UPDATE that sets qc_flags on the rows of the
+    regular data arrays already in the station table'''
+    checks = qc_checks(station)
+    lows, highs = widened(checks)
+    terms = []
+    for (field, check), low, high in zip(checks.iterrows(), lows, highs):
+        conditions = []
+        if np.isfinite(low):
+            conditions.append('%s < %r' % (field, low))
+        if np.isfinite(high):
+            conditions.append('%s > %r' % (field, high))
+        terms.append('CASE WHEN %s THEN %i ELSE 0 END' % (
+                         ' OR '.join(conditions), 1 << int(check.bit)))
+    statement = 'UPDATE %s SET qc_flags = %s WHERE arrayid IN (%s);' % (
+                    tablenames[station], ' + '.join(terms) or '0',
+                    ', '.join('%i' % arrayid for arrayid in checked_arrays(station)))
+    print(statement)
+    if execute:
+        with stage('flag_existing', station=station):
+            engine.execute(statement)
+    return statement
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('stations', nargs='*', default=sorted(tablenames),
+                        help='the stations to check, all of them by default')
+    parser.add_argument('--flag_existing', action='store_true',
+                        help='set qc_flags on the rows already in the database')
+    args = parser.parse_args()
+
+    for station in args.stations:
+        print(station)
+        print(qc_checks(station))
+        if args.flag_existing:
+            # ADDS THE qc_flags COLUMN TO TABLES MADE BEFORE IT
+            from upload_dats import create_table_sql
+            create_table_sql(station, execute=True)
+            flag_existing_rows_sql(station, execute=True)
@@ -0,0 +1,120 @@
+'''Keeps the results of get_data_from_station on disk so plotter runs only
+query the rows added to the database since the last run.  Each station, field
+and interval is stored in its own Parquet file, or a pickle if pyarrow is not
+installed, next to a small json file recording what it covers.  Runs that
+share a cache directory take turns on each station with a lock file.
+'''
+import json
+import pandas as pd
+from os import makedirs, replace
+from os.path import join, exists as fileexists
+from datetime import datetime as dtm, timedelta
+from contextlib import contextmanager
+
+try:
+    import pyarrow
+    _ext = 'parquet'
+except ImportError:
+    _ext = 'pkl'
+
+try:
+    import fcntl
+except ImportError:   # WINDOWS, THE FILES ARE STILL REPLACED ATOMICALLY
+    fcntl = None
+
+
+class ResultCache(object):
+
+    def __init__(self, cachedir, max_days=366):
+        '''Rows older than max_days before now are dropped from the cache,
+        unless a run asks for them'''
+        self.cachedir = cachedir
+        self.max_days = max_days
+        makedirs(cachedir, exist_ok=True)
+
+    def _path(self, station, field, interval):
+        return join(self.cachedir, '%s_%s_%s' % (
+                        station, field, interval.replace(' ', '')))
+
+    def subcache(self, name):
+        '''A cache in a directory of this one, for results fetched another
+        way'''
+        return ResultCache(join(self.cachedir, name), self.max_days)
+
+    @contextmanager
+    def _lock(self, station, interval):
+        lockfile = join(self.cachedir, '%s_%s.lock' % (
+                            station, interval.replace(' ', '')))
+        with open(lockfile, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self, station, field, interval):
+        '''Returns the cached dataframe for a field and the first datetime it
+        covers, or None, None if it is not cached'''
+        path = self._path(station, field, interval)
+        if not fileexists(path + '.json') or not fileexists(path + '.' + _ext):
+            return None, None
+
+        with open(path + '.json', 'r') as f:
+            covered_from = pd.Timestamp(json.load(f)['covered_from'])
+        if _ext == 'parquet':
+            df = pd.read_parquet(path + '.parquet')
+        else:
+            df = pd.read_pickle(path + '.pkl')
+        return df, covered_from
+
+    def write(self, station, field, interval, df, covered_from):
+        '''Stores a single column dataframe for a field, the data file is
+        written before the json so a reader never sees coverage the data
+        does not have'''
+        path = self._path(station, field, interval)
+        if _ext == 'parquet':
+            df.to_parquet(path + '.parquet.tmp')
+        else:
+            df.to_pickle(path + '.pkl.tmp')
+        replace(path + '.%s.tmp' % _ext, path + '.' + _ext)
+
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump({'covered_from': covered_from.isoformat()}, f)
+        replace(path + '.json.tmp', path + '.json')
+
+    def fetch(self, station, fields, start, end, interval, fetcher):
+        '''Returns what fetcher(station, fields, start, end, interval) would,
+        only asking fetcher for the rows after the newest cached row.  If the
+        cache does not reach back to start everything is fetched again'''
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        with self._lock(station, interval):
+            cached = [self.read(station, field, interval) for field in fields]
+
+            complete = all(df is not None and covered_from <= start
+                           for df, covered_from in cached)
+            if complete:
+                old = pd.concat([df for df, _ in cached], axis=1)
+                high_water = old.index.max() if old.shape[0] else start
+                covered_from = max(covered_from for _, covered_from in cached)
+                new = fetcher(station, fields, max(high_water, start), end,
+                              interval)
+                df = pd.concat([old, new])
+                df = df[~df.index.duplicated(keep='last')].sort_index()
+            else:
+                covered_from = start
+                df = fetcher(station, fields, start, end, interval)
+
+            # DROPPING THE ROWS OLDER THAN ANY WINDOW NEEDS
+            cutoff = min(pd.Timestamp(dtm.now() - timedelta(days=self.max_days)),
+                         start)
+            if covered_from < cutoff:
+                df = df[df.index >= cutoff]
+                covered_from = cutoff
+
+            for column in df.columns:
+                field = column[len(station) + 1:]
+                self.write(station, field, interval, df[[column]], covered_from)
+
+        return df[(df.index >= start) & (df.index <= end)]
@@ -0,0 +1,165 @@
+'''Keeps a table of daily min, max, mean and count for every numeric field of
+each station, so long windows and season summaries dont have to pull every
+hourly row.  The days are made from the 1 Hour data array, a day holds the
+rows stamped after midnight up to and including the next midnight, which
+Campbell logs as 2400.
+
+upload2db updates the days it added rows to, to make the tables from
+scratch, like after a backfill, run:
+
+python rollups.py --rebuild SBSP SASP
+'''
+import argparse
+import pandas as pd
+from datetime import timedelta
+from config import *
+from data_access import get_data_arrays, get_header_info, read_sql_with_retry
+from metrics import stage
+
+aggregates = ('min', 'max', 'mean', 'count')
+source_interval = '1 Hour'
+
+
+def rollup_table(station):
+    return '%s_daily' % tablenames[station]
+
+
+def rollup_fields(station):
+    '''The numeric fields of a station from Field_Lists.xlsx plus albedo,
+    leaving out the ones that make up the datetime'''
+    header = get_header_info(station)
+    numeric = header[header.Data_Type.str.contains('Float|Integer')].index
+    return [field for field in numeric
+            if field not in ('arrayid', 'year', 'doy', 'hour')] + \
+           [albedo_info['fieldname']]
+
+
+def create_rollup_sql(station, execute=False):
+    '''Returns (and prints) the SQL that creates the rollup table of a
+    station'''
+    columns = ['day timestamp PRIMARY KEY']
+    for field in rollup_fields(station):
+        columns += ['%s_min real' % field, '%s_max real' % field,
+                    '%s_mean real' % field, '%s_count integer' % field]
+    statement = 'CREATE TABLE IF NOT EXISTS %s (\n%s);' % (
+                    rollup_table(station), ',\n'.join(columns))
+    print(statement)
+    if execute:
+        engine.execute(statement)
+    return statement
+
+
+def compute_rollups(station, first_day, last_day):
+    '''Returns the rollup rows for the days first_day to last_day made from
+    the hourly rows in the station table, indexed by day'''
+    first_day = pd.Timestamp(first_day).normalize()
+    last_day = pd.Timestamp(last_day).normalize()
+    fields = rollup_fields(station)
+    da = get_data_arrays(station)
+    arrayid = da[da.label == source_interval].index[0]
+
+    sql = "SELECT datetime, %s FROM %s WHERE arrayid = %i AND " \
+          "datetime > '%s' AND datetime <= '%s'" % (
+              ', '.join(fields), tablenames[station], arrayid,
+              first_day.strftime(datefmt),
+              (last_day + timedelta(days=1)).strftime(datefmt))
+    df = read_sql_with_retry(sql)
+
+    # MIDNIGHT BELONGS TO THE DAY BEFORE
+    day = (df.index - pd.Timedelta(minutes=1)).normalize()
+    out = df.groupby(day).agg(list(aggregates))
+    out.columns = ['%s_%s' % column for column in out.columns]
+    out.index.name = 'day'
+    return out
+
+
+def update_rollups(station, first_day, last_day):
+    '''Makes the rollup rows for first_day to last_day again and replaces
+    the ones in the table'''
+    with stage('rollup', station=station) as m:
+        df = compute_rollups(station, first_day, last_day)
+        first_day = pd.Timestamp(first_day).normalize()
+        last_day = pd.Timestamp(last_day).normalize()
+        if not engine.has_table(rollup_table(station)):
+            create_rollup_sql(station, execute=True)
+        with engine.begin() as conn:
+            conn.execute("DELETE FROM %s WHERE day >= '%s' AND day <= '%s'" % (
+                             rollup_table(station),
+                             first_day.strftime(datefmt),
+                             last_day.strftime(datefmt)))
+            df.to_sql(rollup_table(station), conn, if_exists='append',
+                      chunksize=1000)
+        m['days'] = df.shape[0]
+    return df
+
+
+def update_rollups_for(station, datetimes):
+    '''Updates the days the hourly rows at datetimes fall in'''
+    datetimes = pd.DatetimeIndex(datetimes)
+    if len(datetimes) == 0:
+        return
+    days = (datetimes - pd.Timedelta(minutes=1)).normalize()
+    update_rollups(station, days.min(), days.max())
+
+
+def rebuild_rollups(station, chunk_days=365):
+    '''Makes the rollup table of a station from scratch, chunk_days at a
+    time'''
+    engine.execute('DROP TABLE IF EXISTS %s' % rollup_table(station))
+    create_rollup_sql(station, execute=True)
+
+    da = get_data_arrays(station)
+    arrayid = da[da.label == source_interval].index[0]
+    first, last = engine.execute(
+        'SELECT MIN(datetime), MAX(datetime) FROM %s WHERE arrayid = %i' % (
+            tablenames[station], arrayid)).fetchall()[0]
+    if first is None:
+        return
+    first = (pd.Timestamp(first) - pd.Timedelta(minutes=1)).normalize()
+    last = (pd.Timestamp(last) - pd.Timedelta(minutes=1)).normalize()
+
+    day = first
+    while day <= last:
+        end = min(day + timedelta(days=chunk_days - 1), last)
+        update_rollups(station, day, end)
+        print('Rolled up %s %s to %s' % (station, day.date(), end.date()))
+        day = end + timedelta(days=1)
+
+
+def get_rollups(station, fields, start, end):
+    '''Returns the daily aggregates for (field, aggregate) pairs between start
+    and end in columns named like sasp_loair_avg_c_max, indexed by the
+    midnight starting each day.  If the rollup table isnt there yet they are
+    made from the hourly rows'''
+    columns = ['%s_%s' % (field, aggregate) for field, aggregate in fields]
+    start = pd.Timestamp(start).normalize()
+    end = pd.Timestamp(end)
+    sql = "SELECT day as datetime, %s FROM %s WHERE day >= '%s' AND day <= '%s'" % (
+              ', '.join(columns), rollup_table(station),
+              start.strftime(datefmt),
+              end.strftime(datefmt))
+    try:
+        df = read_sql_with_retry(sql, retries=0)
+    except Exception:
+        df = compute_rollups(station, start, end)[columns]
+        df.index.name = 'datetime'
+
+    df.columns = ['%s_%s' % (station.lower(), column) for column in columns]
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('stations', nargs='*', default=sorted(tablenames),
+                        help='the stations to roll up, all of them by default')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='make the rollup tables again from every hourly row')
+    parser.add_argument('--chunk_days', type=int, default=365)
+    args = parser.parse_args()
+
+    for station in args.stations:
+        if args.rebuild:
+            rebuild_rollups(station, args.chunk_days)
+        else:
+            create_rollup_sql(station, execute=True)
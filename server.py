@@ -0,0 +1,154 @@
+'''Serves the plots live from the database instead of as a static html file.
+The page starts with the days showing and every time the user pans or zooms
+it asks for just the visible window, at a resolution that fits the plot, so
+the whole archive can be browsed without the page getting any bigger.
+
+As an example:
+
+python server.py /fullpath/to/json/template/file 7 --port 5000
+
+and then open http://localhost:5000/ .  Set CSAS_DB_URL to serve from a
+different database, like a local SQLite copy.
+'''
+import argparse
+import json
+import numpy as np
+import pandas as pd
+from datetime import datetime as dtm, timedelta
+from flask import Flask, request, jsonify, abort
+from bokeh.embed import file_html
+from bokeh.resources import CDN
+from bokeh.models import CustomJS
+from bokeh.models.ranges import Range1d
+from bokeh.models.sources import ColumnDataSource
+from config import *
+from data_access import get_data, get_header_info, column_name
+from rollups import aggregates
+from downsample import downsample
+from plotter import read_template, template_lines, make_layout, plot_width
+
+app = Flask(__name__)
+
+# POINTS PER PIXEL OF PLOT WIDTH SENT FOR THE VISIBLE WINDOW, AND THE MOST
+# POINTS ONE REQUEST CAN ASK FOR
+points_per_pixel = 2
+max_points = 20000
+
+fetch_window = '''
+var settings = %s;
+if (window.csas_timer) {
+  clearTimeout(window.csas_timer);
+}
+// WAITING UNTIL THE USER STOPS PANNING OR ZOOMING
+window.csas_timer = setTimeout(function() {
+  var start = xrange.start, end = xrange.end;
+  settings.lines.forEach(function(line) {
+    var source = xrange.document.get_model_by_name(line.name);
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', 'data/' + line.station + '/' + line.field + '?start=' +
+             start + '&end=' + end + '&points=' + settings.points +
+             (line.aggregate ? '&aggregate=' + line.aggregate : ''));
+    xhr.responseType = 'json';
+    xhr.onload = function() {
+      var data = {datetime: xhr.response.datetime};
+      data[line.name] = xhr.response.values.map(function(v) {
+        return v === null ? NaN : v;
+      });
+      source.data = data;
+    };
+    xhr.send();
+  });
+}, 250);
+'''
+
+
+def query_window(lines, start, end, points):
+    '''Gets the data for the lines between start and end from the coarsest
+    data arrays that still have enough points and downsamples each line to
+    about points points'''
+    df = get_data(lines, start, end, 'auto', min_points=points)
+    return dict((column, downsample(df[[column]].dropna(), points, 'lttb'))
+                for column in df.columns)
+
+
+@app.route('/data/<station>/<field>')
+def data(station, field):
+    '''The data for one station and field as json, start and end are in
+    milliseconds since 1970 like bokeh uses.  Give aggregate, like max, for
+    the daily aggregate from the rollup table'''
+    if station not in tablenames:
+        abort(404)
+    fields = list(get_header_info(station).index) + [albedo_info['fieldname']]
+    if field not in fields:
+        abort(404)
+
+    try:
+        start = pd.Timestamp(float(request.args['start']), unit='ms')
+        end = pd.Timestamp(float(request.args['end']), unit='ms')
+        points = int(request.args.get('points', plot_width * points_per_pixel))
+    except (KeyError, ValueError):
+        abort(400)
+    aggregate = request.args.get('aggregate')
+    if aggregate is not None and aggregate not in aggregates:
+        abort(400)
+    points = min(max(points, 10), max_points)
+
+    line = {'station': station, 'field': field, 'aggregate': aggregate}
+    column = column_name(line)
+    df = query_window([line], start, end, points)[column]
+
+    # NaN ISNT VALID JSON, float32 VALUES GO OUT WITH THEIR SHORTEST DIGITS
+    values = df[column].astype(str).astype(float).astype(object)
+    values = values.where(df[column].notnull(), None)
+    milliseconds = df.index.values.astype('datetime64[ms]').astype(np.int64)
+    return jsonify(datetime=milliseconds.tolist(), values=values.tolist())
+
+
+@app.route('/')
+def page():
+    '''The page for the template with the days showing loaded, it fetches
+    more data from /data as the user pans and zooms'''
+    template = app.config['template']
+    end = dtm.now()
+    start = end - timedelta(days=app.config['days_showing'])
+    points = plot_width * points_per_pixel
+
+    lines = []
+    for line in template_lines(template):
+        name = column_name(line)
+        if name not in [l['name'] for l in lines]:
+            lines.append({'name': name, 'station': line['station'],
+                          'field': line['field'],
+                          'aggregate': line.get('aggregate')})
+
+    dfs = query_window(lines, start, end, points)
+    sources = dict((name, ColumnDataSource(df, name=name))
+                   for name, df in dfs.items())
+
+    xrange = Range1d(start=start, end=end)
+    callback = CustomJS(args=dict(xrange=xrange), code=fetch_window %
+                        json.dumps({'lines': lines, 'points': points}))
+    xrange.js_on_change('start', callback)
+    xrange.js_on_change('end', callback)
+
+    layout = make_layout(template, sources, xrange)
+    return file_html(layout, CDN, 'CSAS Data')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('jsonfile',
+                        help='the full path to the json template file',
+                        type=str)
+    parser.add_argument('days_showing',
+                        help='The number of days of data to show on the inital ' +
+                        'page load',
+                        type=int)
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=5000, type=int)
+    args = parser.parse_args()
+
+    app.config.update(template=read_template(args.jsonfile),
+                      days_showing=args.days_showing)
+    app.run(host=args.host, port=args.port)
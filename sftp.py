@@ -1,48 +1,142 @@
 from paramiko import Transport, SFTPClient
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from os.path import getsize
+import threading
+import posixpath
 import time
 import errno
 import logging
+from metrics import stage, count
 logging.basicConfig(format='%(levelname)s : %(message)s',
                     level=logging.INFO)
 
 
 class SftpClient:
+    '''One authenticated connection to a server that files are published
+    over.  Uploads go to a temporary name and are renamed into place so a
+    web server never serves half a file, and each file gets a .sha256 file
+    next to it so unchanged files are not sent again'''
 
-    _connection = None
-
-    def __init__(self, host, port, username, password):
+    def __init__(self, host, port, username, password, channels=4,
+                 progress_secs=5, transport=None):
+        '''channels is how many files upload_many sends at once, each over
+        its own channel of the same connection.  Progress is logged at most
+        every progress_secs.  An already connected paramiko Transport can be
+        given instead of the host and login, to test against a stand-in
+        server'''
         self.host = host
         self.port = port
         self.username = username
         self.password = password
+        self.channels = channels
+        self.progress_secs = progress_secs
+
+        if transport is None:
+            transport = Transport(sock=(host, port))
+            transport.connect(username=username, password=password)
+        self._transport = transport
+        self._local = threading.local()
+        self._opened = []
+        self._opened_lock = threading.Lock()
+        # KEPT FOR THE LIFE OF THE CLIENT SO ITS THREADS KEEP THEIR CHANNELS
+        self._pool = ThreadPoolExecutor(max_workers=channels)
 
-        self.create_connection(self.host, self.port,
-                               self.username, self.password)
+    @property
+    def _connection(self):
+        '''The SFTP channel of the calling thread, opened the first time a
+        thread uses it'''
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = SFTPClient.from_transport(self._transport)
+            self._local.connection = connection
+            with self._opened_lock:
+                self._opened.append(connection)
+        return connection
 
-    @classmethod
-    def create_connection(cls, host, port, username, password):
+    def uploading_info(self, remote_path):
+        '''Returns a progress callback for paramiko that logs at most every
+        progress_secs and when the file is done'''
+        last = [time.time()]
 
-        transport = Transport(sock=(host, port))
-        transport.connect(username=username, password=password)
-        cls._connection = SFTPClient.from_transport(transport)
+        def callback(uploaded_file_size, total_file_size):
+            now = time.time()
+            if uploaded_file_size == total_file_size or \
+                    now - last[0] >= self.progress_secs:
+                last[0] = now
+                logging.info('{} : uploaded_file_size : {} total_file_size : {}'.
+                             format(remote_path, uploaded_file_size, total_file_size))
+        return callback
 
     @staticmethod
-    def uploading_info(uploaded_file_size, total_file_size):
+    def file_hash(local_path):
+        h = sha256()
+        with open(local_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def is_current(self, local_path, remote_path, digest=None):
+        '''True if the remote file has the size of the local one and its
+        .sha256 file has the same hash'''
+        digest = digest or self.file_hash(local_path)
+        try:
+            if self._connection.stat(remote_path).st_size != getsize(local_path):
+                return False
+            with self._connection.open(remote_path + '.sha256', 'r') as f:
+                return f.read().decode().strip() == digest
+        except IOError:
+            return False
+
+    def _put_atomic(self, local_path, remote_path, callback=None):
+        '''Puts a file under a temporary name in the same directory and then
+        renames it over remote_path'''
+        tmp_path = posixpath.join(posixpath.dirname(remote_path),
+                                  '.%s.%i.tmp' % (posixpath.basename(remote_path),
+                                                  threading.get_ident()))
+        try:
+            self._connection.put(localpath=local_path, remotepath=tmp_path,
+                                 callback=callback, confirm=True)
+            self._connection.posix_rename(tmp_path, remote_path)
+        except Exception:
+            try:
+                self._connection.remove(tmp_path)
+            except IOError:
+                pass
+            raise
+
+    def upload(self, local_path, remote_path, force=False):
+        '''Uploads a file unless the remote copy already matches it, returns
+        True if it was uploaded'''
+        digest = self.file_hash(local_path)
+        if not force and self.is_current(local_path, remote_path, digest):
+            logging.info('{} is already up to date'.format(remote_path))
+            count('sftp_skipped')
+            return False
 
-        logging.info('uploaded_file_size : {} total_file_size : {}'.
-                     format(uploaded_file_size, total_file_size))
+        with stage('sftp_upload') as m:
+            self._put_atomic(local_path, remote_path,
+                             callback=self.uploading_info(remote_path))
+            m['bytes_sent'] = getsize(local_path)
 
-    def upload(self, local_path, remote_path):
+        # THE HASH GOES UP AFTER THE FILE, IF THIS IS CUT SHORT THE FILE JUST
+        # GETS SENT AGAIN NEXT TIME
+        tmp_path = remote_path + '.sha256.%i.tmp' % threading.get_ident()
+        with self._connection.open(tmp_path, 'w') as f:
+            f.write(digest + '\n')
+        self._connection.posix_rename(tmp_path, remote_path + '.sha256')
+        return True
 
-        self._connection.put(localpath=local_path,
-                             remotepath=remote_path,
-                             callback=self.uploading_info,
-                             confirm=True)
+    def upload_many(self, paths, force=False):
+        '''Uploads a list of (local_path, remote_path) at the same time over
+        up to channels channels, returns whether each one was uploaded'''
+        futures = [self._pool.submit(self.upload, local_path, remote_path, force)
+                   for local_path, remote_path in paths]
+        return [future.result() for future in futures]
 
     def file_exists(self, remote_path):
 
         try:
-            print('remote path : ', remote_path)
             self._connection.stat(remote_path)
         except IOError as e:
             if e.errno == errno.ENOENT:
@@ -51,14 +145,20 @@ class SftpClient:
         else:
             return True
 
-    def download(self, remote_path, local_path, retry=5):
+    def download(self, remote_path, local_path, retry=5, wait_secs=5):
+        '''Downloads a file, waiting wait_secs and then twice as long each
+        time for up to retry times if it isnt there yet'''
+        for attempt in range(retry):
+            if self.file_exists(remote_path):
+                break
+            count('sftp_download_retries')
+            time.sleep(wait_secs * 2 ** attempt)
+        self._connection.get(remote_path, local_path, callback=None)
 
-        if self.file_exists(remote_path) or retry == 0:
-            self._connection.get(remote_path, local_path,
-                                 callback=None)
-        elif retry > 0:
-            time.sleep(5)
-            retry = retry - 1
-            self.download(remote_path, local_path, retry=retry)
     def close(self):
-        self._connection.close()
+        self._pool.shutdown()
+        with self._opened_lock:
+            for connection in self._opened:
+                connection.close()
+            self._opened = []
+        self._transport.close()
@@ -0,0 +1,51 @@
+'''Checks the chunked reads and checkpoints of backfill.py.  Run with
+
+python -m pytest test_backfill.py
+'''
+import sys
+import importlib
+from os.path import dirname, abspath, join
+import backfill
+
+datfile = join(dirname(abspath(__file__)), 'SBSP-Met Station.dat')
+
+
+def test_read_chunks_reads_the_last_line_without_a_newline(tmpdir):
+    path = tmpdir.join('archive.dat')
+    path.write_binary(b'a,1\nb,2\nc,3')
+    chunks = list(backfill.read_chunks(str(path), chunk_rows=2))
+    assert chunks == [(b'a,1\nb,2\n', 8), (b'c,3\n', 11)]
+    assert list(backfill.read_chunks(str(path), offset=8)) == [(b'c,3\n', 11)]
+
+
+def test_same_named_archives_get_their_own_checkpoints(tmpdir):
+    first = str(tmpdir.mkdir('2010').join('SBSP.dat'))
+    second = str(tmpdir.mkdir('2011').join('SBSP.dat'))
+    assert backfill.checkpoint_path('SBSP', first) != \
+           backfill.checkpoint_path('SBSP', second)
+    assert backfill.checkpoint_path('SBSP', first) == \
+           backfill.checkpoint_path('SBSP', join(first, '..', 'SBSP.dat'))
+
+
+def test_imports_without_resource(monkeypatch):
+    # WINDOWS DOESNT HAVE IT
+    monkeypatch.setitem(sys.modules, 'resource', None)
+    try:
+        module = importlib.reload(backfill)
+        assert module.peak_rss_mb() is None
+        assert module._mb(None) == 'unknown'
+    finally:
+        monkeypatch.undo()
+        importlib.reload(backfill)
+
+
+def test_backfill_file_resumes_from_its_checkpoint(sbsp_table, tmpdir, monkeypatch):
+    monkeypatch.setattr(backfill, 'backfill_checkpoint_dir', str(tmpdir))
+    result = backfill.backfill_file('SBSP', datfile, chunk_rows=100,
+                                    method='to_sql')
+    assert result['rows_read'] == result['rows_inserted'] == 552
+
+    # THE WHOLE FILE IS ALREADY LOADED, NOTHING IS READ AGAIN
+    result = backfill.backfill_file('SBSP', datfile, chunk_rows=100,
+                                    method='to_sql')
+    assert result['rows_read'] == 0 and result['rows_inserted'] == 552
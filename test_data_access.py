@@ -0,0 +1,82 @@
+'''Checks the parts of data_access.py that dont need the station tables.
+Run with
+
+python -m pytest test_data_access.py
+'''
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from data_access import read_sql_with_retry, compact_frame
+
+# COUNTS FAR ENOUGH TO TAKE MINUTES
+slow_sql = ('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) '
+            'SELECT MAX(i) AS datetime FROM n')
+
+
+def test_the_database_stops_a_query_at_the_timeout():
+    started = time.time()
+    with pytest.raises(Exception, match='interrupted'):
+        read_sql_with_retry(slow_sql, timeout_secs=0.5, retries=0)
+    assert time.time() - started < 2
+
+
+def test_the_connection_is_left_without_a_timeout():
+    read_sql_with_retry('SELECT 1 AS datetime', timeout_secs=0.01, retries=0)
+    time.sleep(0.05)
+    # THE SAME POOLED CONNECTION ISNT INTERRUPTED BY THE OLD DEADLINE
+    assert read_sql_with_retry('SELECT 1 AS datetime').shape[0] == 1
+
+
+def test_rows_at_the_bounds_are_returned(sbsp_table, tmpdir):
+    import pandas as pd
+    from os.path import dirname, abspath, join
+    from upload_dats import DatFile
+    from data_access import get_data_from_station
+    dat = DatFile('SBSP', join(dirname(abspath(__file__)), 'SBSP-Met Station.dat'))
+    dat.uploadlogfile = str(tmpdir.join('upload.log'))
+    dat.upload2db(catch_upload=False)
+
+    start, end = pd.Timestamp('2016-06-21 00:00'), pd.Timestamp('2016-06-22 00:00')
+    df = get_data_from_station('SBSP', ['loair_avg_c'], start, end, '1 Hour')
+    assert df.index.min() == start and df.index.max() == end
+    assert df.shape[0] == 25
+
+
+def test_compact_frame_makes_float64_columns_float32():
+    df = pd.DataFrame({'a': [1.5, np.nan, -12.2], 'b': [1, 2, 3],
+                       'c': ['x', 'y', 'z']})
+    found = compact_frame(df)
+    assert list(found.dtypes) == [np.float32, np.int64, object]
+    np.testing.assert_allclose(found.a, df.a, rtol=1e-6)
+    assert found.a.isnull().tolist() == [False, True, False]
+
+
+def test_compact_frame_uses_the_dtypes_given():
+    df = pd.DataFrame({'arrayid': [201., 203.], 'value': [0.25, 1e6]})
+    found = compact_frame(df, {'arrayid': 'int16', 'value': 'float32'})
+    assert found.arrayid.dtype == np.int16
+    assert found.value.dtype == np.float32
+    assert list(found.arrayid) == [201, 203]
+
+
+def test_compact_frame_keeps_columns_that_dont_fit(capsys):
+    # WHOLE NUMBERS HAVE TO COME BACK EXACTLY, THIS ONE ROUNDS IN FLOAT32
+    df = pd.DataFrame({'big': [16777217., 1.], 'blank': [np.nan, 2.],
+                       'fine': [0.1, 0.2]})
+    found = compact_frame(df, {'big': 'float32', 'blank': 'int16',
+                               'fine': 'float32'})
+    assert found.big.dtype == np.float64
+    assert found.blank.dtype == np.float64
+    assert found.fine.dtype == np.float32
+    printed = capsys.readouterr().out
+    assert 'Keeping big as float64' in printed
+    assert 'Keeping blank as float64' in printed
+
+
+def test_compact_frame_keeps_the_index_and_empty_frames():
+    index = pd.date_range('2016-06-20', periods=3, freq='H', name='datetime')
+    df = pd.DataFrame({'a': [1., 2., 3.]}, index=index)
+    assert compact_frame(df).index.equals(index)
+    empty = df.iloc[:0]
+    assert compact_frame(empty) is empty
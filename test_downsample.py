@@ -0,0 +1,69 @@
+'''Checks the downsampling plotter.py does before embedding plot data.  Run
+with
+
+python -m pytest test_downsample.py
+'''
+import numpy as np
+import pandas as pd
+import pytest
+from downsample import lttb_indices, minmax_indices, downsample
+
+
+def spiky(n=1000, spike=437):
+    x = np.arange(n, dtype=float)
+    y = np.sin(x / 50.)
+    y[spike] = 10.
+    return x, y
+
+
+@pytest.mark.parametrize('pick', [lttb_indices, minmax_indices])
+def test_short_input_is_kept_whole(pick):
+    x, y = spiky(10, spike=4)
+    np.testing.assert_array_equal(pick(x, y, 20), np.arange(10))
+    np.testing.assert_array_equal(pick(x, y, 10), np.arange(10))
+
+
+def test_lttb_returns_n_out_points_in_order():
+    x, y = spiky()
+    found = lttb_indices(x, y, 100)
+    assert len(found) == 100
+    assert found[0] == 0 and found[-1] == len(x) - 1
+    assert (np.diff(found) > 0).all()
+
+
+@pytest.mark.parametrize('pick', [lttb_indices, minmax_indices])
+def test_a_spike_survives(pick):
+    x, y = spiky()
+    assert 437 in pick(x, y, 100)
+
+
+def test_minmax_keeps_the_extremes_of_each_bin():
+    x, y = spiky()
+    found = minmax_indices(x, y, 100)
+    assert found[0] == 0 and found[-1] == len(x) - 1
+    assert len(found) <= 100 + 2
+    edges = np.linspace(x[0], x[-1], 100 // 2 + 1)
+    for low, high in zip(edges[:-2], edges[1:-1]):
+        inbin = np.flatnonzero((x >= low) & (x < high))
+        assert inbin[np.argmin(y[inbin])] in found
+        assert inbin[np.argmax(y[inbin])] in found
+
+
+def test_downsample_keeps_the_edges_of_missing_data():
+    index = pd.date_range('2016-06-20', periods=1000, freq='H')
+    x, y = spiky()
+    y[600:700] = np.nan
+    df = pd.DataFrame({'a': y}, index=index)
+    found = downsample(df, 100)
+    assert found.shape[0] < df.shape[0]
+    for position in (599, 600, 699, 700):
+        assert index[position] in found.index
+
+
+def test_downsample_leaves_small_frames_and_none_alone():
+    df = pd.DataFrame({'a': np.arange(50.)},
+                      index=pd.date_range('2016-06-20', periods=50, freq='H'))
+    assert downsample(df, 100) is df
+    assert downsample(pd.concat([df] * 4), 10, mode='none').shape[0] == 200
+    with pytest.raises(ValueError):
+        downsample(df, 10, mode='mean')
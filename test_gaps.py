@@ -0,0 +1,72 @@
+'''Checks finding the gaps in the rows of the regular data arrays.  Run with
+
+python -m pytest test_gaps.py
+'''
+import pandas as pd
+from gaps import find_gaps, gap_columns
+
+intervals = pd.Series({201: 60, 203: 180}, name='intervalminutes')
+
+
+def keys(arrayid, datetimes):
+    return pd.DataFrame({'arrayid': arrayid,
+                         'datetime': pd.to_datetime(datetimes)})
+
+
+def hourly(start, periods, arrayid=201):
+    return keys(arrayid, pd.date_range(start, periods=periods, freq='H'))
+
+
+def test_no_gaps():
+    gaps = find_gaps(hourly('2016-06-20', 48), intervals)
+    assert list(gaps.columns) == gap_columns
+    assert gaps.shape[0] == 0
+
+
+def test_a_gap_runs_from_the_row_before_to_the_row_after():
+    rows = pd.concat([hourly('2016-06-20 00:00', 10),
+                      hourly('2016-06-20 15:00', 10)])
+    gaps = find_gaps(rows, intervals)
+    assert gaps.shape[0] == 1
+    gap = gaps.iloc[0]
+    assert gap.arrayid == 201
+    assert gap.gap_start == pd.Timestamp('2016-06-20 09:00')
+    assert gap.gap_end == pd.Timestamp('2016-06-20 15:00')
+    assert gap.missing == 5
+
+
+def test_a_late_row_counts_the_rows_that_should_have_been_between():
+    gaps = find_gaps(keys(201, ['2016-06-20 00:00', '2016-06-20 01:30']),
+                     intervals)
+    assert list(gaps.missing) == [1]
+
+
+def test_each_array_against_its_own_interval():
+    rows = pd.concat([hourly('2016-06-20', 24),
+                      keys(203, pd.date_range('2016-06-20', periods=8,
+                                              freq='3H')),
+                      keys(203, ['2016-06-21 09:00'])])
+    gaps = find_gaps(rows, intervals)
+    assert list(gaps.arrayid) == [203]
+    assert list(gaps.missing) == [3]
+
+
+def test_rows_out_of_order_and_other_arrays():
+    rows = pd.concat([hourly('2016-06-20 05:00', 5), hourly('2016-06-20', 3),
+                      keys(212, ['2016-06-20 12:00', '2016-06-25 12:00'])])
+    gaps = find_gaps(rows, intervals)
+    assert list(gaps.gap_start) == [pd.Timestamp('2016-06-20 02:00')]
+    assert list(gaps.gap_end) == [pd.Timestamp('2016-06-20 05:00')]
+
+
+def test_too_few_rows():
+    assert find_gaps(hourly('2016-06-20', 1), intervals).shape[0] == 0
+    assert find_gaps(hourly('2016-06-20', 0), intervals).shape[0] == 0
+
+
+def test_time_zone_aware_datetimes():
+    rows = keys(201, pd.to_datetime(['2016-06-20 00:00', '2016-06-20 03:00'])
+                .tz_localize('UTC'))
+    gaps = find_gaps(rows, intervals)
+    assert gaps.gap_start.iloc[0] == pd.Timestamp('2016-06-20 00:00')
+    assert list(gaps.missing) == [2]
@@ -0,0 +1,68 @@
+'''Checks the data files payload.py writes for plotter.py --external_data.
+Run with
+
+python -m pytest test_payload.py
+'''
+import struct
+import numpy as np
+import pandas as pd
+from payload import write_payload, read_payload, add_loader, payload_suffix
+
+
+def frame(n, columns=('sbsp_loair_avg_c', 'sasp_loair_avg_c')):
+    index = pd.DatetimeIndex(pd.date_range('2016-06-20', periods=n, freq='H').values,
+                             name='datetime')
+    values = np.arange(n * len(columns), dtype=np.float32).reshape(n, len(columns))
+    values[1:2, 0] = np.nan
+    return pd.DataFrame(values, index=index, columns=list(columns))
+
+
+def test_round_trip(tmpdir):
+    df = frame(25)
+    path = str(tmpdir.join('page' + payload_suffix))
+    write_payload(df, path)
+    pd.testing.assert_frame_equal(read_payload(path), df)
+
+
+def test_empty_frame(tmpdir):
+    df = frame(0)
+    path = str(tmpdir.join('page' + payload_suffix))
+    write_payload(df, path)
+    assert read_payload(path).shape == (0, 2)
+
+
+def test_arrays_start_on_8_bytes(tmpdir):
+    for name in ('a', 'ab', 'abc', 'abcd', 'abcdefgh'):
+        path = str(tmpdir.join('page' + payload_suffix))
+        write_payload(frame(3, [name]), path)
+        with open(path, 'rb') as f:
+            length, = struct.unpack('<I', f.read(4))
+        assert (4 + length) % 8 == 0
+
+
+def test_page_doesnt_change_with_the_data(tmpdir):
+    pages = []
+    for n in (10, 20):
+        path = str(tmpdir.join('page' + payload_suffix))
+        manifest = write_payload(frame(n), path)
+        htmlfile = tmpdir.join('page%i.html' % n)
+        htmlfile.write('<html><body></body></html>')
+        add_loader(str(htmlfile), manifest, 'csas_data')
+        pages.append(htmlfile.read())
+    assert pages[0] == pages[1]
+
+
+def test_data_goes_up_before_the_pages():
+    from plotter import remote_paths, upload_rendered
+
+    class Sftp(object):
+        calls = []
+
+        def upload_many(self, paths):
+            self.calls.append([remote for local, remote in paths])
+
+    uploads = remote_paths(['/out/a.html', '/out/a' + payload_suffix], '/www/a.html') + \
+              remote_paths(['/out/b.html', '/out/b' + payload_suffix], '/www/b.html')
+    upload_rendered(Sftp(), uploads)
+    assert Sftp.calls == [['/www/a' + payload_suffix, '/www/b' + payload_suffix],
+                          ['/www/a.html', '/www/b.html']]
@@ -0,0 +1,66 @@
+'''Checks the Data Check ranges qc.py reads from Field_Lists.xlsx and the
+flags it sets with them.  Run with
+
+python -m pytest test_qc.py
+'''
+import numpy as np
+import pandas as pd
+import pytest
+from qc import parse_data_check, qc_checks, qc_flags, flag_existing_rows_sql
+
+
+@pytest.mark.parametrize('text, bounds', [
+    ('-60ºC — +50ºC', (-60, 50)),
+    ('0-100%', (0, 100)),
+    ('12.2 - 15.0 V', (12.2, 15.0)),
+    ('0,1', (0, 1)),
+    ('>12', (12, np.inf)),
+    ('<5', (-np.inf, 5)),
+    ('0 - 2000 W/m2', (0, 2000)),
+    ('W/m2', None),
+    (np.nan, None),
+])
+def test_parse_data_check(text, bounds):
+    assert parse_data_check(text) == bounds
+
+
+def volts(values, dtype):
+    checks = qc_checks('SBSP')
+    return checks, pd.DataFrame({'sys_volts': np.array(values, dtype)})
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_range_edges_arent_flagged(dtype):
+    checks, df = volts([12.2, 15.0, 13.0, np.nan], dtype)
+    assert (checks.loc['sys_volts', ['low', 'high']] == [12.2, 15.0]).all()
+    assert list(qc_flags(df, checks)) == [0, 0, 0, 0]
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_outside_the_range_is_flagged(dtype):
+    checks, df = volts([12.19, 15.01, -7999], dtype)
+    bit = 1 << int(checks.bit['sys_volts'])
+    assert list(qc_flags(df, checks)) == [bit, bit, bit]
+
+
+def test_only_the_checked_arrays_are_flagged():
+    checks = qc_checks('SBSP')
+    index = pd.MultiIndex.from_arrays([[201, 212], pd.to_datetime(['2016-06-20'] * 2)],
+                                      names=['arrayid', 'datetime'])
+    df = pd.DataFrame({'sys_volts': [0., 0.]}, index=index)
+    flags = qc_flags(df, checks, arrayids=[201])
+    assert flags[0] != 0 and flags[1] == 0
+
+
+def test_flag_existing_rows_at_the_range_edges(sbsp_table):
+    from config import engine
+    for hour, value in enumerate([12.2, 15.0, 12.19]):
+        # STORED THE WAY THE FLOAT32 FRAMES LEAVE IT
+        engine.execute("INSERT INTO %s (datetime, arrayid, sys_volts) "
+                       "VALUES ('2016-06-20 0%i:00:00', 201, %r)" % (
+                           sbsp_table, hour, float(np.float32(value))))
+    flag_existing_rows_sql('SBSP', execute=True)
+    flags = engine.execute('SELECT qc_flags FROM %s ORDER BY datetime' %
+                           sbsp_table).fetchall()
+    bit = 1 << int(qc_checks('SBSP').bit['sys_volts'])
+    assert [row[0] & bit for row in flags] == [0, 0, bit]
@@ -0,0 +1,166 @@
+'''Checks reading the dat files shipped with the repo against the row by row
+datetime conversion upload_dats.py used before doy2datetime.  Run with
+
+python -m pytest test_upload_dats.py
+'''
+import re
+from glob import glob
+from datetime import datetime as dtm, timedelta
+from os.path import basename, dirname, abspath, join
+import numpy as np
+import pandas as pd
+import pytest
+from upload_dats import DatFile, doy2datetime, get_header_info, next_time_
+
+datfiles = sorted(glob(join(dirname(abspath(__file__)), '*.dat')))
+
+
+def doyDate2datetime(row):
+    '''The old conversion, one row at a time'''
+    year = row['year']
+    doy = row['doy']
+    # THE ROWS COME THROUGH apply AS FLOATS, 130.0 WOULD SPLIT THE SAME BUT
+    # THE 0 OF MIDNIGHT WOULDNT SPLIT AT ALL
+    time = '%04i' % row['hour']
+    _, hours, mins, _ = (re.split(r'(\d?\d)(\d\d)', time))
+    return dtm(int(year), 1, 1) + timedelta(int(doy) - 1,
+                                            hours=int(hours),
+                                            minutes=int(mins))
+
+
+def read_plain(datfile):
+    station = basename(datfile)[:4]
+    return station, pd.read_csv(datfile, names=get_header_info(station).index)
+
+
+def test_all_dat_files_found():
+    assert len(datfiles) == 4
+
+
+@pytest.mark.parametrize('datfile', datfiles, ids=basename)
+def test_doy2datetime_matches_the_old_conversion(datfile):
+    station, df = read_plain(datfile)
+    expected = pd.to_datetime(df[['year', 'doy', 'hour']]
+                              .apply(doyDate2datetime, axis=1)).values
+    found = doy2datetime(df.year, df.doy, df.hour)
+    assert found.dtype == np.dtype('datetime64[ns]')
+    np.testing.assert_array_equal(found, expected)
+
+
+@pytest.mark.parametrize('datfile', datfiles, ids=basename)
+def test_2400_rolls_over_to_the_next_day(datfile):
+    station, df = read_plain(datfile)
+    df = df[df.hour == 2400]
+    if not df.shape[0]:
+        pytest.skip('no 2400 rows in %s' % basename(datfile))
+    found = pd.DatetimeIndex(doy2datetime(df.year, df.doy, df.hour))
+    assert list(found) == [pd.Timestamp(dtm(year, 1, 1) + timedelta(int(doy)))
+                           for year, doy in zip(df.year, df.doy)]
+
+
+@pytest.mark.parametrize('datfile', datfiles, ids=basename)
+def test_datfile_reads_every_row(datfile):
+    station, df = read_plain(datfile)
+    dat = DatFile(station, datfile)
+    assert dat.rawfile.shape[0] == df.shape[0]
+
+    expected = pd.to_datetime(df.apply(doyDate2datetime, axis=1))
+    assert sorted(dat.rawfile.index.get_level_values('datetime')) == \
+           sorted(expected)
+
+
+def scratch_datfile(tmpdir, rawfile):
+    dat = DatFile('SBSP', join(dirname(abspath(__file__)), 'SBSP-Met Station.dat'))
+    dat.table = 'test_senator_beck'
+    dat.uploadlogfile = str(tmpdir.join('upload.log'))
+    dat.checkpointfile = str(tmpdir.join('checkpoint.json'))
+    if rawfile is not None:
+        dat.rawfile = rawfile
+    return dat
+
+
+def table_rows(table):
+    from config import engine
+    return engine.execute('SELECT COUNT(*) FROM %s' % table).fetchall()[0][0]
+
+
+def test_gap_after_rows_already_uploaded_stops_the_insert(sbsp_table, tmpdir):
+    full = scratch_datfile(tmpdir, None).rawfile
+    datetimes = full.index.get_level_values('datetime')
+    uploaded = datetimes < '2016-06-23'
+    missing = (datetimes >= '2016-06-23') & (datetimes < '2016-06-24')
+    scratch_datfile(tmpdir, full[uploaded]).upload2db(catch_upload=False)
+    assert table_rows(sbsp_table) == uploaded.sum()
+
+    # THE FILE STILL HAS THE ROWS ALREADY UPLOADED, THEN A DAY IS MISSING
+    dat = scratch_datfile(tmpdir, full[~missing])
+    dat.upload2db(insert_despite_interval_issue=False, catch_upload=False)
+    assert table_rows(sbsp_table) == uploaded.sum()
+    assert 'Opted to not upload' in tmpdir.join('upload.log').read()
+
+    dat = scratch_datfile(tmpdir, full[~missing])
+    dat.upload2db(catch_upload=False)
+    assert table_rows(sbsp_table) == (~missing).sum()
+
+
+def test_rows_already_uploaded_arent_gaps(sbsp_table, tmpdir):
+    full = scratch_datfile(tmpdir, None).rawfile
+    hourly = full.index.get_level_values('arrayid') == 201
+    hole = np.zeros(full.shape[0], bool)
+    hole[np.flatnonzero(hourly)[20:30]] = True
+    scratch_datfile(tmpdir, full[~hole].iloc[:-50]).upload2db(catch_upload=False)
+    tmpdir.join('upload.log').remove()
+
+    # FILLING THE HOLE AND ADDING THE LAST ROWS LEAVES NO GAPS
+    dat = scratch_datfile(tmpdir, full)
+    dat.upload2db(insert_despite_interval_issue=False, catch_upload=False)
+    assert table_rows(sbsp_table) == full.shape[0]
+    assert 'hours from the last data point' not in tmpdir.join('upload.log').read()
+
+
+def test_incremental_reads_take_a_complete_last_line_without_a_newline(tmpdir, monkeypatch):
+    import upload_dats
+    monkeypatch.setattr(upload_dats, 'upload_logfile_dir', str(tmpdir))
+    with open(join(dirname(abspath(__file__)), 'SBSP-Met Station.dat'), 'rb') as f:
+        lines = f.read().split(b'\r\n')
+    path = tmpdir.join('SBSP.dat')
+
+    def read(data):
+        # LOGGERNET ENDS THE FILE WITHOUT A NEWLINE
+        path.write_binary(data)
+        dat = DatFile('SBSP', str(path), incremental=True)
+        dat.save_checkpoint()
+        return dat.rawfile
+
+    assert read(b'\r\n'.join(lines[:-3])).shape[0] == len(lines) - 3
+    # THE NEWEST RECORD COMES IN RIGHT AWAY, NOT WITH THE ONE AFTER IT
+    assert read(b'\r\n'.join(lines[:-2])).shape[0] == 1
+    # HALF A RECORD IS LEFT UNTIL THE REST OF IT IS WRITTEN
+    half = lines[-2][:len(lines[-2]) // 2]
+    assert read(b'\r\n'.join(lines[:-2] + [half])).shape[0] == 0
+    assert read(b'\r\n'.join(lines[:-1])).shape[0] == 1
+    assert read(b'\r\n'.join(lines) + b'\r\n').shape[0] == 1
+    assert read(b'\r\n'.join(lines) + b'\r\n').shape[0] == 0
+
+
+@pytest.mark.parametrize('hold_til, now, expected', [
+    ('min', '2016-06-20 10:15:30', '2016-06-20 10:16:00'),
+    ('min', '2016-06-20 10:16:00', '2016-06-20 10:16:00'),
+    ('hour', '2016-06-20 10:15:00', '2016-06-20 11:00:00'),
+    ('5 sec', '2016-06-20 10:15:07', '2016-06-20 10:15:10'),
+    ('15 min', '2016-06-20 10:50:00', '2016-06-20 11:00:00'),
+    # THE COUNT STARTS OVER AT MIDNIGHT, NOT AT 25:00
+    ('5 hour', '2016-06-20 21:00:00', '2016-06-21 00:00:00'),
+    ('5 hour', '2016-06-20 23:59:59', '2016-06-21 00:00:00'),
+])
+def test_next_time(hold_til, now, expected):
+    assert next_time_(hold_til, pd.Timestamp(now).to_pydatetime()) == \
+           pd.Timestamp(expected).to_pydatetime()
+
+
+def test_next_time_bad_options():
+    now = dtm(2016, 6, 20, 10, 15)
+    with pytest.raises(NotImplementedError):
+        next_time_('1 sec', now)
+    with pytest.raises(ValueError):
+        next_time_('2 day', now)
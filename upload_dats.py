@@ -1,12 +1,61 @@
 from pdb import set_trace
+from copy import copy
 import pandas as pd
-from os.path import join, splitext
+from os import stat
+from os.path import join, splitext, exists as fileexists, getsize, \
+     abspath, dirname
+from io import BytesIO, StringIO
+from hashlib import sha1
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dtm, timedelta
 import re
 import numpy as np
 import time
+import sqlalchemy
 from config import *
 from data_access import *
+from metrics import stage, count, write_textfile
+from rollups import update_rollups_for, source_interval as rollup_interval
+from qc import qc_checks, qc_flags, checked_arrays
+from gaps import (regular_intervals, find_gaps, neighbours, frame_bounds,
+                  update_gaps_for, gap_columns)
+
+def next_time_(hold_til='min', now=None):
+    """Returns the next time at or after now that is an even time.  See
+    hold_til_ for the options"""
+    if now is None:
+        now = dtm.now()
+
+    if hold_til == 'hour':
+        interval, unit = 1, 'hour'
+    elif hold_til == 'min':
+        interval, unit = 1, 'min'
+    else:
+        if '1 sec' in hold_til:
+            raise NotImplementedError('cant yet do a single second')
+
+        interval, unit = re.split('\s+', hold_til)
+        interval = int(interval)
+
+    # THE TIMES ARE COUNTED FROM THE START OF THE NEXT BIGGER UNIT, SO
+    # '5 hour' IS 0, 5, 10, 15 AND 20 AND THEN MIDNIGHT AGAIN
+    if 'sec' in unit:
+        origin = now.replace(second=0, microsecond=0)
+        period, step = 60, interval
+    elif 'min' in unit:
+        origin = now.replace(minute=0, second=0, microsecond=0)
+        period, step = 3600, interval * 60
+    elif 'hour' in unit:
+        origin = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        period, step = 86400, interval * 3600
+    else:
+        raise ValueError('Unknown unit in %s' % hold_til)
+
+    elapsed = (now - origin).total_seconds()
+    seconds = min(np.ceil(elapsed / step) * step, period)
+    return origin + timedelta(seconds=seconds)
 
 def hold_til_(hold_til='min', accuracy_secs=1):
     """This will stall until you are at an even time.  For exmaple:
@@ -16,107 +65,377 @@ def hold_til_(hold_til='min', accuracy_secs=1):
     '5 sec'  hold until 5, 10, 15, 20 ... seconds for the time
     '2 min'  hold until the top of the min at 2 min intervals
     '3 hour'  hold until the top of the hour at 3 hour intervals
-    """
-    now = dtm.now()
-
-    if hold_til == 'hour':
-        # wait until the top of the hour
-        while now.minute != 0 or now.second != 0:
-            now = dtm.now()
-            time.sleep(accuracy_secs)
 
-    elif hold_til == 'min':
-        while now.second != 0:
-            now = dtm.now()
-            time.sleep(accuracy_secs)
+    It sleeps straight through to that time, accuracy_secs is kept so old
+    calls still work but it is no longer used
+    """
+    until = next_time_(hold_til)
+    while dtm.now() < until:
+        time.sleep((until - dtm.now()).total_seconds() + 0.01)
+
+class _PollWatcher(object):
+    '''Watches files for changes by checking their size and modification
+    time every poll_secs seconds'''
+
+    def __init__(self, filepaths, poll_secs=5):
+        self.filepaths = filepaths
+        self.poll_secs = poll_secs
+        self.stats = dict((fp, self._stat(fp)) for fp in filepaths)
+
+    @staticmethod
+    def _stat(filepath):
+        try:
+            st = stat(filepath)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def wait(self, timeout):
+        '''Returns the set of files that changed, waiting up to timeout
+        seconds for one to change'''
+        deadline = time.time() + timeout
+        while True:
+            changed = set()
+            for fp in self.filepaths:
+                st = self._stat(fp)
+                if st != self.stats[fp]:
+                    self.stats[fp] = st
+                    changed.add(fp)
+
+            remaining = deadline - time.time()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.poll_secs, remaining))
+
+class _InotifyWatcher(object):
+    '''Watches files for changes with inotify, this needs the inotify_simple
+    package.  The directories are watched rather than the files themselves
+    so files that are replaced are still picked up'''
+
+    def __init__(self, filepaths):
+        from inotify_simple import INotify, flags
+
+        self.filepaths = set(filepaths)
+        self.inotify = INotify()
+        mask = flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        self.dirs = {}
+        for directory in set(dirname(fp) for fp in filepaths):
+            self.dirs[self.inotify.add_watch(directory, mask)] = directory
+
+    def wait(self, timeout):
+        '''Returns the set of files that changed, waiting up to timeout
+        seconds for one to change'''
+        events = self.inotify.read(timeout=int(max(timeout, 0) * 1000))
+        paths = set(join(self.dirs[e.wd], e.name) for e in events)
+        return paths & self.filepaths
+
+def watch_datfiles(filepaths, callback, debounce_secs=30, poll_secs=5,
+                   schedule=None):
+    '''Calls callback with a list of the dat files that changed, once they
+have gone debounce_secs without changing again, so LoggerNet has finished
+writing them.  Uses inotify when inotify_simple is installed and otherwise
+checks the files every poll_secs.  If schedule is given, like '1 hour', the
+callback is also called with every file at those times.  This never returns'''
+    filepaths = [abspath(fp) for fp in filepaths]
+    try:
+        watcher = _InotifyWatcher(filepaths)
+    except (ImportError, OSError):
+        watcher = _PollWatcher(filepaths, poll_secs)
+
+    pending = set()
+    last_change = None
+    next_run = next_time_(schedule) if schedule else None
+    while True:
+        timeout = 3600.
+        if pending:
+            timeout = debounce_secs - (time.time() - last_change)
+        if next_run is not None:
+            timeout = min(timeout, (next_run - dtm.now()).total_seconds())
+
+        changed = watcher.wait(max(timeout, 0))
+        if changed:
+            pending |= changed
+            last_change = time.time()
+
+        if next_run is not None and dtm.now() >= next_run:
+            callback(list(filepaths))
+            pending = set()
+            next_run = next_time_(schedule, dtm.now() + timedelta(seconds=1))
+        elif pending and time.time() - last_change >= debounce_secs:
+            callback(sorted(pending))
+            pending = set()
+
+def upload_log_path(station):
+    '''Returns the path to the log file for a station's uploads'''
+    return join(upload_logfile_dir, "%s_upload_log.txt" % station)
+
+def doy2datetime(year, doy, hhmm):
+    """Converts whole columns of year, day of year and Campbell HHMM times
+    (e.g. 130 for 1:30 am) to datetime64 values using integer arithmetic.
+    A time of 2400 rolls over to midnight of the following day, the same as
+    adding a timedelta of 24 hours would."""
+    year = np.asarray(year, dtype=np.int64)
+    doy = np.asarray(doy, dtype=np.int64)
+    hhmm = np.asarray(hhmm, dtype=np.int64)
+
+    # DAYS SINCE THE EPOCH FOR JANUARY 1ST OF EACH YEAR
+    jan1 = (year - 1970).astype('datetime64[Y]').astype('datetime64[D]')
+    minutes = (doy - 1) * 1440 + (hhmm // 100) * 60 + hhmm % 100
+
+    out = jan1.astype('datetime64[m]') + minutes.astype('timedelta64[m]')
+    return out.astype('datetime64[ns]')
+
+def parse_datlines(data, header):
+    '''Parses complete lines of a dat file, as bytes, into a dataframe with
+    the columns in header indexed by arrayid and datetime.  The columns get
+    the compact dtypes of field_dtypes'''
+    if data.strip():
+        # PANDAS WONT READ A SINGLE LINE WITH FEWER FIELDS THAN THE HEADER,
+        # LIKE AN INCREMENTAL READ OF ONE 3 HOUR ROW, IT IS PADDED OUT
+        line = data.rstrip(b'\r\n')
+        if b'\n' not in line:
+            data = line + b',' * (len(header.index) - line.count(b',') - 1) + b'\n'
+        rawfile = pd.read_csv(BytesIO(data), names=header.index)
+        rawfile = compact_frame(rawfile, field_dtypes(header))
     else:
-        if '1 sec' in hold_til:
-            raise NotImplementedError('cant yet do a single second')
-
-        interval, unit = re.split('\s+', hold_til)
-        interval = int(interval)
+        rawfile = pd.DataFrame(columns=header.index)
 
-        if 'sec' in unit:
-            while now.second % interval != 0:
-                now = dtm.now()
-                time.sleep(accuracy_secs)
-        if 'min' in unit:
-            while now.minute % interval != 0 or now.second != 0:
-                now = dtm.now()
-                time.sleep(accuracy_secs)
-        if 'hour' in unit:
-            while now.minute != 0 or now.second != 0 or \
-                  now.hour % interval != 0:
-                now = dtm.now()
-                time.sleep(accuracy_secs)
+    rawfile['datetime'] = doy2datetime(rawfile['year'], rawfile['doy'],
+                                       rawfile['hour'])
+    rawfile.set_index(['arrayid', 'datetime'], drop=True, inplace=True)
+    rawfile.sort_index(inplace=True)
+    return rawfile
 
 class DatFile(object):
     tablenames = tablenames
 
-    def __init__(self, station, datfile_path=None):
+    def __init__(self, station, datfile_path=None, incremental=False):
         '''Open a dat file, specify a station by its four character
 capitalized name like SBSP, and specify the full path to the dat file.
-the dat file is now contained in a pandas dataframe at dat.rawfile'''
-
-        # used to convert a DOY to a python datetime object
-        def doyDate2datetime(row):
-            year = row['year']
-            doy = row['doy']
-            time = str(row['hour'])
-            _, hours, mins, _ = (re.split('(\d?\d)(\d\d)', time))
-            return dtm(int(year), 1, 1) + timedelta(int(doy) - 1,
-                                                         hours=int(hours),
-                                                         minutes=int(mins))
+the dat file is now contained in a pandas dataframe at dat.rawfile
+
+If incremental is True only the rows appended to the dat file since the
+last checkpoint are read.  The checkpoint is written by upload2db after a
+successful upload, if the file was truncated or rotated since then the
+whole file is read again'''
 
         self.station = station
         self.datfile_path = datfile_path
         self.table = self.tablenames[station]
+        self.incremental = incremental
 
-        self.uploadlogfile = join(upload_logfile_dir,
-                                  "%s_upload_log.txt" % self.station)
+        self.uploadlogfile = upload_log_path(station)
+        self.checkpointfile = join(upload_logfile_dir,
+                                   "%s_checkpoint.json" % self.station)
 
         self.header = get_header_info(station)
         self.data_arrays = get_data_arrays(station)
 
-        self.rawfile = pd.read_csv(datfile_path,
-                                   names=self.header.index, dtype={'Hour': str})
-        self.rawfile['datetime'] = self.rawfile.apply(doyDate2datetime, axis=1)
-        self.rawfile.set_index(['arrayid', 'datetime'], drop=True, inplace=True)
-        self.rawfile.sort_index(inplace=True)
+        previous = self.load_checkpoint() if incremental else None
+        offset = self.resume_offset(previous)
+        if offset == 0:
+            previous = None
+
+        with stage('read_dat', station=station) as m:
+            self.rawfile, self.checkpoint = self._read_from(offset, previous)
+            m['rows'] = self.rawfile.shape[0]
+            m['bytes_read'] = self.checkpoint['offset'] - offset
+
+    def _read_from(self, offset, previous=None):
+        '''Reads the complete lines of the dat file after the byte offset and
+returns the dataframe along with the checkpoint to store once it has been
+uploaded'''
+        with open(self.datfile_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+
+        # LOGGERNET DOESNT END THE LAST LINE OF A FILE WITH A NEWLINE, ON
+        # INCREMENTAL READS IT IS ONLY TAKEN IF IT HAS AS MANY FIELDS AS THE
+        # LAST COMPLETE LINE OF ITS ARRAY, OTHERWISE IT IS STILL BEING WRITTEN
+        # AND IS LEFT FOR NEXT TIME.  THE CHECKPOINT STOPS BEFORE IT EITHER
+        # WAY, SO IT IS READ AGAIN AND DROPPED WITH THE ROWS ALREADY SEEN
+        complete = data[:data.rfind(b'\n') + 1]
+        widths = {} if previous is None else dict(previous.get('widths', {}))
+        widths.update(self._line_widths(complete))
+        if self.incremental and not self._line_is_complete(
+                data[len(complete):], widths):
+            data = complete
+        rawfile = parse_datlines(data, self.header)
+
+        # DROPPING ANY ROWS AT OR BEFORE THE LAST ONE SEEN FOR THEIR ARRAYID
+        last_rows = {} if previous is None else dict(previous['last_rows'])
+        if last_rows and rawfile.shape[0]:
+            seen = pd.Series({int(k): np.datetime64(v)
+                              for k, v in last_rows.items()})
+            arrayids = rawfile.index.get_level_values('arrayid')
+            cutoff = seen.reindex(arrayids).values
+            datetimes = rawfile.index.get_level_values('datetime').values
+            rawfile = rawfile[~(datetimes <= cutoff)]
+
+        if rawfile.shape[0]:
+            newest = rawfile.reset_index().groupby('arrayid').datetime.max()
+            for arrayid, datetime in newest.items():
+                last_rows[str(int(arrayid))] = datetime.isoformat()
+
+        end = offset + len(complete)
+        tail_start = complete.rfind(b'\n', 0, len(complete) - 1) + 1
+        if len(complete):
+            tail_hash = sha1(complete[tail_start:]).hexdigest()
+            tail_start = offset + tail_start
+        elif previous is not None:
+            tail_hash = previous['tail_hash']
+            tail_start = previous['tail_start']
+        else:
+            tail_hash, tail_start = None, 0
+
+        checkpoint = {'datfile_path': self.datfile_path, 'offset': end,
+                      'tail_start': tail_start, 'tail_hash': tail_hash,
+                      'last_rows': last_rows, 'widths': widths}
+        return rawfile, checkpoint
+
+    def _line_widths(self, data):
+        '''The number of fields in the last line of each data array in data,
+        by arrayid'''
+        data = b'\n' + data
+        widths = {}
+        for arrayid in self.data_arrays.index:
+            start = data.rfind(b'\n%i,' % arrayid)
+            if start >= 0:
+                end = data.find(b'\n', start + 1)
+                widths[str(arrayid)] = data.count(b',', start, end) + 1
+        return widths
+
+    @staticmethod
+    def _line_is_complete(line, widths):
+        '''True if a line without a newline has as many fields as widths says
+        a line of its array has'''
+        if not line.strip():
+            return False
+        arrayid = line.split(b',', 1)[0].decode(errors='replace')
+        return widths.get(arrayid) == line.count(b',') + 1
+
+    def load_checkpoint(self):
+        '''Returns the stored checkpoint for this station or None'''
+        if not fileexists(self.checkpointfile):
+            return None
+        with open(self.checkpointfile, 'r') as f:
+            return json.load(f)
+
+    def save_checkpoint(self):
+        '''Stores the byte offset and last rows read from the dat file so the
+next incremental read only parses the rows appended after them'''
+        if not self.incremental or self.checkpoint is None:
+            return
+        with open(self.checkpointfile, 'w') as f:
+            json.dump(self.checkpoint, f)
+
+    def resume_offset(self, checkpoint):
+        '''Returns the byte offset to resume reading from, or 0 if there is
+no checkpoint or the dat file was truncated or rotated since it was made'''
+        if checkpoint is None or checkpoint['tail_hash'] is None:
+            return 0
+        if checkpoint['datfile_path'] != self.datfile_path:
+            return 0
+
+        offset = checkpoint['offset']
+        if getsize(self.datfile_path) < offset:
+            self.log_full_read('truncated')
+            return 0
+
+        # THE LAST LINE READ MUST STILL BE WHERE WE LEFT IT
+        with open(self.datfile_path, 'rb') as f:
+            f.seek(checkpoint['tail_start'])
+            tail = f.read(offset - checkpoint['tail_start'])
+        if sha1(tail).hexdigest() != checkpoint['tail_hash']:
+            self.log_full_read('rotated')
+            return 0
+
+        return offset
+
+    @classmethod
+    def from_rows(cls, station, datfile_path, rawfile):
+        '''Makes a DatFile around rows already parsed with parse_datlines
+        instead of reading the file'''
+        new = cls.__new__(cls)
+        new.station = station
+        new.datfile_path = datfile_path
+        new.table = cls.tablenames[station]
+        new.incremental = False
+        new.header = get_header_info(station)
+        new.data_arrays = get_data_arrays(station)
+        new.rawfile = rawfile
+        new.uploadlogfile = upload_log_path(station)
+        new.checkpointfile = join(upload_logfile_dir,
+                                  "%s_checkpoint.json" % station)
+        new.checkpoint = None
+        return new
 
     def copy(self):
         'Copies the dat python object not the dat file itself'
         new = DatFile.__new__(DatFile)
         new.station = self.station
+        new.datfile_path = self.datfile_path
         new.table = self.table
+        new.incremental = self.incremental
         new.header = self.header.copy()
         new.data_arrays = self.data_arrays.copy()
         new.rawfile = self.rawfile.copy()
         new.uploadlogfile = self.uploadlogfile
+        new.checkpointfile = self.checkpointfile
+        new.checkpoint = copy(self.checkpoint)
         return new
 
     def clear_rows_already_in_database(self, inplace=True):
         '''Clears the rawfile dataframe of any arrayid and datetimes
-that match one in the database'''
-        done=False
-        while not done:
-            try:
-                alreadyup = engine.execute("""SELECT arrayid,datetime
-                            FROM %s;""" % self.table).fetchall()
-                done=True
-            except:
-                done=False
-                print('Connection Failed at %s' % dtm.now())
-                time.sleep(5)
+that match one in the database.  Only the keys inside the datetime range
+of each arrayid in the rawfile are pulled from the database'''
+        alreadyup = []
+        sql = self.existing_keys_sql()
+        done = sql is None
+        with stage('clear_rows', station=self.station) as m:
+            while not done:
+                try:
+                    alreadyup = engine.execute(sql).fetchall()
+                    done=True
+                except:
+                    done=False
+                    print('Connection Failed at %s' % dtm.now())
+                    count('db_retries', stage='clear_rows', station=self.station)
+                    time.sleep(5)
+            m['rows_in_db'] = len(alreadyup)
+
+        keys = pd.DataFrame(alreadyup, columns=['arrayid', 'datetime'])
+        keys['datetime'] = pd.to_datetime(keys.datetime)
+        if keys.datetime.dt.tz is not None:
+            keys['datetime'] = keys.datetime.dt.tz_localize(None)
+        keys = pd.MultiIndex.from_arrays([keys.arrayid, keys.datetime])
 
         if inplace:
-            self.rawfile = self.rawfile[~self.rawfile.index.isin(alreadyup)]
+            self.rawfile = self.rawfile[~self.rawfile.index.isin(keys)]
             return self
         else:
             new = self.copy()
-            new.rawfile = self.rawfile[~self.rawfile.index.isin(alreadyup)]
+            new.rawfile = self.rawfile[~self.rawfile.index.isin(keys)]
             return new
 
+    def existing_keys_sql(self):
+        '''Returns the query for the arrayid and datetimes in the database
+that overlap the rawfile, or None if the rawfile is empty'''
+        if self.rawfile.shape[0] == 0:
+            return None
+
+        bounds = self.rawfile.reset_index().groupby('arrayid').datetime
+        bounds = pd.concat([bounds.min(), bounds.max()], axis=1,
+                           keys=['start', 'end'])
+
+        clauses = ["(arrayid = %i AND datetime BETWEEN '%s' AND '%s')" % (
+                       arrayid, row.start.strftime(datefmt),
+                       row.end.strftime(datefmt))
+                   for arrayid, row in bounds.iterrows()]
+
+        return "SELECT arrayid, datetime FROM %s WHERE %s;" % (
+                    self.table, ' OR '.join(clauses))
+
     def add_albedo(self):
         '''Adds albedo to the rawfile'''
         self.rawfile[albedo_info['fieldname']] = \
@@ -125,70 +444,139 @@ that match one in the database'''
         infs = self.rawfile[albedo_info['fieldname']].isin([np.inf,-np.inf])
         self.rawfile.loc[infs, albedo_info['fieldname']] = np.nan
 
-    def check_dat_interval_after_db(self, arrayid):
-        """ Here we are checking to make sure that the first row in the dat file
-         is exactly is one interval after the last row in the database for a
-         specific data array id.  The function returns true if they are timed
-         correctly and if they are incorrect it returns the difference in
-         minutes, and the two times"""
-
-        intervalminutes = self.data_arrays.loc[arrayid].intervalminutes
-
-        last_date_inDB = get_last_date(self.table, arrayid)[0][0]
-        if last_date_inDB is None:
-            return True
-
-        last_date_inDB = last_date_inDB.replace(tzinfo=None)
-
-        first_date_in_dat = self.rawfile.loc[arrayid].index.min().to_pydatetime()
-
-        diff_minutes = (first_date_in_dat - last_date_inDB).total_seconds()/60.
-
-        if diff_minutes == intervalminutes:
-            return True
-        else:
-            return diff_minutes, first_date_in_dat, last_date_inDB
+    def add_qc_flags(self):
+        '''Adds the qc_flags column, see qc.py.  Run it after add_albedo so
+albedo is checked too'''
+        with stage('qc', station=self.station) as m:
+            self.rawfile['qc_flags'] = qc_flags(self.rawfile,
+                                                qc_checks(self.station),
+                                                checked_arrays(self.station))
+            m['rows_flagged'] = int((self.rawfile['qc_flags'] != 0).sum())
+
+    def find_gaps(self, new=None):
+        """ Returns the gaps (see gaps.find_gaps) in the regular data arrays
+         of the rawfile, including the one between the last row in the
+         database before each array and its first row in the rawfile.
+
+         new is the index of the rows about to be inserted, all of them if it
+         isnt given.  Only the gaps that end on a new row are returned, the
+         ones that start on a row that isnt new, one already in the
+         database, have boundary set to True"""
+        if new is None:
+            new = self.rawfile.index
+        intervals = regular_intervals(self.station)
+        keys = self.rawfile.index.to_frame(index=False)[['arrayid', 'datetime']]
+        keys = keys[keys.arrayid.isin(intervals.index)]
+        if keys.shape[0] == 0:
+            return pd.DataFrame(columns=gap_columns + ['boundary'])
+
+        # THE LAST ROW IN THE DATABASE BEFORE EACH ARRAY, ONE QUERY FOR ALL
+        previous = neighbours(self.station,
+                              frame_bounds(self.station, self.rawfile)).previous
+        previous = previous.dropna()
+        keys = pd.concat([keys, pd.DataFrame({'arrayid': previous.index,
+                                              'datetime': previous.values})])
+        gaps = find_gaps(keys, intervals)
+        gaps = gaps[pd.MultiIndex.from_arrays([gaps.arrayid, gaps.gap_end])
+                      .isin(new)]
+        gaps['boundary'] = ~pd.MultiIndex.from_arrays(
+                               [gaps.arrayid, gaps.gap_start]).isin(new)
+        return gaps
+
+    def newest_rows_in_database(self):
+        """ Returns the datetime of the newest row in the database of each
+         arrayid in the rawfile, NaT where there are none"""
+        arrayids = self.rawfile.index.get_level_values('arrayid').unique()
+        # THE ROW BEFORE THE LAST POSSIBLE DATETIME IS THE NEWEST ONE
+        latest = pd.Timestamp.max.floor('s')
+        bounds = pd.DataFrame({'start': latest, 'end': latest},
+                              index=pd.Index(arrayids, name='arrayid'))
+        return neighbours(self.station, bounds).previous
 
     def upload2db(self, insert_despite_interval_issue=True,
-                  catch_upload=True):
+                  catch_upload=True, method='copy', chunksize=50000):
         '''Uploads the rawfile to the database, it checks to remove duplicate
         rows, and checks the intervals, if the intervals show there are hours
-        missing it still uploads but logs the upload in the log file'''
-
-        # REMOVING DATA FROM THE FILE THAT ALREADY EXISTS IN THE DATABASE
-        upload = self.clear_rows_already_in_database(inplace=True)
+        missing it still uploads but logs the upload in the log file.
+
+        method='copy' streams the rows with COPY FROM STDIN on PostgreSQL and
+        falls back to DataFrame.to_sql on other databases, method='to_sql'
+        always uses to_sql.  method='upsert' leaves removing the duplicate
+        rows to the unique (arrayid, datetime) index on PostgreSQL'''
+
+        # REMOVING DATA FROM THE FILE THAT ALREADY EXISTS IN THE DATABASE,
+        # THE WHOLE FILE IS KEPT TO LOOK FOR GAPS IN, CLEARING THE ROWS
+        # REPLACES THE RAWFILE SO A SHALLOW COPY KEEPS IT
+        whole = copy(self)
+        if method == 'upsert' and engine.dialect.name == 'postgresql':
+            upload = self
+            # UPSERT DOESNT LOOK UP THE ROWS ALREADY IN THE DATABASE, THE ONES
+            # AFTER THE NEWEST ROW OF THEIR ARRAY ARE TAKEN AS THE NEW ONES
+            newest = self.newest_rows_in_database()
+            keys = self.rawfile.index
+            cutoff = newest.reindex(keys.get_level_values('arrayid')).values
+            new = keys[~(keys.get_level_values('datetime').values <= cutoff)]
+        else:
+            upload = self.clear_rows_already_in_database(inplace=True)
+            new = upload.rawfile.index
         uploadf = upload.rawfile
         nrows = uploadf.shape[0]
         if nrows == 0:
             self.log_no_new_rows()
+            self.save_checkpoint()
             return
 
-        # CHECKING THE INTERVALS TO SEE IF WE ARE MISSING RECORDS
-        # THIS MIGHT BE UNNECESSARY
-        arrayids = uploadf.index.get_level_values('arrayid').unique()
-        for arrayid in arrayids:
-            good = upload.check_dat_interval_after_db(arrayid)
-            if good is not True:
-                if not insert_despite_interval_issue:
-                    upload.log_did_not_insert(arrayid, good[0])
-                    return
-                else:
-                    upload.log_break_in_records(arrayid, good[0])
+        # CHECKING THE INTERVALS TO SEE IF WE ARE MISSING RECORDS, BETWEEN
+        # THE DATABASE AND THE FILE AND INSIDE THE FILE.  THE ROWS ALREADY IN
+        # THE DATABASE WOULD LOOK LIKE GAPS IF THEY WERE CLEARED FIRST, AND
+        # ONLY THE GAPS BEFORE A NEW ROW ARE LOGGED SO THEY ARENT LOGGED AGAIN
+        # EVERY TIME THE FILE IS READ.  A GAP AFTER A ROW ALREADY IN THE
+        # DATABASE STOPS THE INSERT WITHOUT insert_despite_interval_issue
+        gaps = whole.find_gaps(new)
+        for _, gap in gaps[gaps.boundary].iterrows():
+            if not insert_despite_interval_issue:
+                upload.log_did_not_insert(gap.arrayid, upload._gap_minutes(gap))
+                return
+        for _, gap in gaps.iterrows():
+            upload.log_break_in_records(gap.arrayid, upload._gap_minutes(gap),
+                                        gap.gap_start)
 
         if catch_upload:
             try:
-                uploadf.reset_index().to_sql(self.table, engine,
-                                         'public', 'append',
-                                         index=False)
+                with stage('insert', station=self.station, method=method) as m:
+                    inserted = m['rows'] = insert_frame(
+                        uploadf.reset_index(), self.table, method, chunksize,
+                        schema='public')
             except Exception:
                 upload.log_upload_failed()
                 return
         else:
-            uploadf.reset_index().to_sql(self.table, engine,
-                                         None, 'append',
-                                         index=False)
-
-        upload.log_successful()
+            with stage('insert', station=self.station, method=method) as m:
+                inserted = m['rows'] = insert_frame(
+                    uploadf.reset_index(), self.table, method, chunksize)
+
+        upload.log_successful(inserted)
+        self.save_checkpoint()
+
+        # MAKING THE DAILY ROLLUPS AGAIN FOR THE DAYS THAT GOT NEW HOURLY ROWS,
+        # THEY CAN ALWAYS BE REBUILT SO THIS DOESNT FAIL THE UPLOAD
+        hourly = self.data_arrays[self.data_arrays.label == rollup_interval].index
+        arrayids = uploadf.index.get_level_values('arrayid')
+        try:
+            update_rollups_for(self.station, uploadf[arrayids.isin(hourly)]
+                               .index.get_level_values('datetime'))
+        except Exception as e:
+            upload._log('Updating the rollups failed at %s: %r' % (dtm.now(), e))
+        # AND THE GAPS AROUND THE NEW ROWS
+        try:
+            update_gaps_for(self.station, uploadf)
+        except Exception as e:
+            upload._log('Updating the gaps failed at %s: %r' % (dtm.now(), e))
+
+    @staticmethod
+    def _gap_minutes(gap):
+        return (pd.Timestamp(gap.gap_end) -
+                pd.Timestamp(gap.gap_start)).total_seconds() / 60.
 
     def _log(self, txt, log=True, stdout=True):
         txt = txt + '\n'
@@ -203,14 +591,23 @@ that match one in the database'''
 is %s hours from the last data point""" % (arrayid, minutediff/60.)
         self._log(txt, log, stdout)
 
-    def log_break_in_records(self, arrayid, minutediff, log=True, stdout=True):
+    def log_break_in_records(self, arrayid, minutediff, after=None, log=True,
+                             stdout=True):
         txt = """ Uploading data from arrayid %s that
 is %s hours from the last data point""" % (arrayid, minutediff/60.)
+        if after is not None:
+            txt += ' at %s' % after
+        self._log(txt, log, stdout)
+
+    def log_successful(self, nrows=None, log=True, stdout=True):
+        if nrows is None:
+            nrows = self.rawfile.shape[0]
+        txt = 'Successful upload of %s records at %s' % (nrows, dtm.now())
         self._log(txt, log, stdout)
 
-    def log_successful(self, log=True, stdout=True):
-        txt = 'Successful upload of %s records at %s' % (
-                     self.rawfile.shape[0], dtm.now())
+    def log_full_read(self, reason, log=True, stdout=True):
+        txt = 'Dat file %s was %s since the last checkpoint, reading all of it at %s' % (
+                     self.datfile_path, reason, dtm.now())
         self._log(txt, log, stdout)
 
     def log_no_new_rows(self, log=True, stdout=True):
@@ -224,30 +621,201 @@ is %s hours from the last data point""" % (arrayid, minutediff/60.)
         self._log(txt, log, stdout)
 
 
-def create_table_sql(station, tablename):
-    '''Helper function to make a table'''
+def copy_frame_to_db(frame, table, chunksize=50000, schema=None):
+    '''Streams a dataframe into a PostgreSQL table as CSV with COPY FROM
+    STDIN.  All of the chunks are loaded in a single transaction which is
+    rolled back if any of them fail'''
+    if schema is not None:
+        table = '%s.%s' % (schema, table)
+    sql = 'COPY %s (%s) FROM STDIN WITH CSV' % (table, ', '.join(frame.columns))
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for start in range(0, frame.shape[0], chunksize):
+            buf = StringIO()
+            # %.15g WRITES WHOLE NUMBER FLOATS WITHOUT THE .0 SO THEY LOAD
+            # INTO INTEGER COLUMNS, EMPTY FIELDS LOAD AS NULL
+            frame.iloc[start:start + chunksize].to_csv(
+                buf, index=False, header=False, float_format='%.15g',
+                date_format='%Y-%m-%d %H:%M:%S')
+            buf.seek(0)
+            cursor.copy_expert(sql, buf)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def upsert_frame_to_db(frame, table, chunksize=50000, schema=None):
+    '''Inserts a dataframe into a PostgreSQL table with INSERT ... ON CONFLICT
+    DO NOTHING, so rows whose (arrayid, datetime) are already in the table
+    are skipped by the server.  Needs the unique index made by
+    create_table_sql.  Returns the number of rows inserted'''
+    from psycopg2.extras import execute_values
+
+    if schema is not None:
+        table = '%s.%s' % (schema, table)
+    sql = 'INSERT INTO %s (%s) VALUES %%s ' % (table, ', '.join(frame.columns)) + \
+          'ON CONFLICT (arrayid, datetime) DO NOTHING'
+
+    values = frame.astype(object).where(frame.notnull(), None)
+    rows = list(values.itertuples(index=False, name=None))
+
+    inserted = 0
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for start in range(0, len(rows), chunksize):
+            execute_values(cursor, sql, rows[start:start + chunksize],
+                           page_size=chunksize)
+            inserted += cursor.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return inserted
+
+def insert_frame(frame, table, method='copy', chunksize=50000, schema=None):
+    '''Appends a dataframe to a table and returns the number of rows
+    inserted.  On PostgreSQL method='copy' uses COPY and method='upsert' uses
+    INSERT ... ON CONFLICT DO NOTHING, otherwise DataFrame.to_sql is used'''
+    if method not in ('copy', 'upsert', 'to_sql'):
+        raise ValueError('Unknown upload method %s' % method)
+
+    if method == 'copy' and engine.dialect.name == 'postgresql':
+        copy_frame_to_db(frame, table, chunksize, schema)
+    elif method == 'upsert' and engine.dialect.name == 'postgresql':
+        return upsert_frame_to_db(frame, table, chunksize, schema)
+    else:
+        frame.to_sql(table, engine, schema, 'append', index=False,
+                     chunksize=chunksize)
+    return frame.shape[0]
+
+add_qc_flags_sql = 'ALTER TABLE %s ADD COLUMN qc_flags bigint;'
+
+def lacks_qc_flags(tablename):
+    '''True if the table is there but was made before the qc_flags column'''
+    if not engine.has_table(tablename):
+        return False
+    existing = [column['name'] for column in
+                sqlalchemy.inspect(engine).get_columns(tablename)]
+    return 'qc_flags' not in existing
+
+def create_table_sql(station, tablename=None, partition_years=None,
+                     execute=False):
+    '''Helper function to make a table.  Returns (and prints) the SQL that
+    creates the station table with a unique index on (arrayid, datetime).
+    Give partition_years, like range(2016, 2021), to range partition the
+    table on datetime with a partition for each year.  With execute=True the
+    statements are also run, tables and indices that already exist are left
+    alone so this also adds the unique index and the qc_flags column to an
+    existing table'''
+    if tablename is None:
+        tablename = tablenames[station]
     df = get_header_info(station)
 
-    print('CREATE TABLE %s (' % tablename)
-    print('%s_ID SERIAL PRIMARY KEY,' % tablename)
-    print('datetime timestamp,')
-    print('albedo real,')
-    for name, dtype in df.Data_Type[:-1].iteritems():
+    columns = ['datetime timestamp NOT NULL', 'albedo real', 'qc_flags bigint']
+    for name, dtype in df.Data_Type.items():
         if 'Float' in dtype:
             dtype = 'real'
         elif 'Integer' in dtype:
             dtype = 'integer'
-        print("%s %s," % (name, dtype))
-    lastvalue = df.Data_Type.iloc[-1]
-    if 'Float' in lastvalue:
-        lastvalue = 'real'
-    elif 'Integer' in lastvalue:
-        lastvalue = 'integer'
-    print("%s %s);" % (df.index[-1], lastvalue))
+        columns.append("%s %s" % (name, dtype))
+
+    if partition_years is None:
+        columns.insert(0, '%s_ID SERIAL PRIMARY KEY' % tablename)
+        partitioning = ''
+    else:
+        # A PRIMARY KEY ON A PARTITIONED TABLE HAS TO INCLUDE DATETIME
+        columns.insert(0, '%s_ID SERIAL' % tablename)
+        partitioning = ' PARTITION BY RANGE (datetime)'
+
+    statements = ['CREATE TABLE IF NOT EXISTS %s (\n%s)%s;' % (
+                      tablename, ',\n'.join(columns), partitioning)]
+
+    for year in partition_years or []:
+        statements.append(
+            "CREATE TABLE IF NOT EXISTS %s_%i PARTITION OF %s "
+            "FOR VALUES FROM ('%i-01-01') TO ('%i-01-01');" % (
+                tablename, year, tablename, year, year + 1))
+    if partition_years is not None:
+        statements.append('CREATE TABLE IF NOT EXISTS %s_default '
+                          'PARTITION OF %s DEFAULT;' % (tablename, tablename))
+
+    statements.append('CREATE UNIQUE INDEX IF NOT EXISTS %s_arrayid_datetime_idx '
+                      'ON %s (arrayid, datetime);' % (tablename, tablename))
+
+    # TABLES MADE BEFORE THERE WERE QC FLAGS GET THE COLUMN ADDED
+    if execute and lacks_qc_flags(tablename):
+        statements.insert(1, add_qc_flags_sql % tablename)
+
+    for statement in statements:
+        print(statement)
+        if execute:
+            engine.execute(statement)
+    return statements
+
+
+def ingest_station(station, filepath):
+    '''Reads the new rows of a station's dat file and uploads them'''
+    with stage('ingest', station=station):
+        dat = DatFile(station, filepath, incremental=True)    # opening the file
+        if station in ('SASP','SBSP'):
+            dat.add_albedo()
+        dat.add_qc_flags()
+        dat.upload2db(catch_upload=False)                     # uploading the file
+
+def ingest_stations(stationlist, max_workers=db_pool_size):
+    '''Runs ingest_station for each [station, filepath] in stationlist at the
+    same time in a pool of threads, which share the engine's connection pool.
+    A station that fails has the error written to its log file and does not
+    stop the others.  Returns a dict of the seconds each station took'''
+    def run(station, filepath):
+        start = time.time()
+        try:
+            ingest_station(station, filepath)
+        except Exception as e:
+            with open(upload_log_path(station), 'a') as up:
+                up.write('Ingest of %s failed at %s: %r\n' % (
+                             filepath, dtm.now(), e))
+            print('Ingest of %s failed: %r' % (station, e))
+        return time.time() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [(station, pool.submit(run, station, filepath))
+                   for station, filepath in stationlist]
+        seconds = dict((station, future.result())
+                       for station, future in futures)
+
+    for station, secs in seconds.items():
+        print('%s took %.2f seconds' % (station, secs))
+    write_textfile('upload_dats')
+    return seconds
 
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description="""
+Uploads the dat files to the database when the script starts and then keeps
+uploading them.  By default it uploads every file at 12 past each hour, with
+--watch it uploads each file a few seconds after LoggerNet writes to it.""")
+    parser.add_argument('--watch', action='store_true',
+                        help='watch the dat files and upload them when they ' +
+                        'change instead of at 12 past each hour')
+    parser.add_argument('--debounce_secs', type=float, default=30,
+                        help='with --watch, wait until a file has not changed ' +
+                        'for this many seconds before uploading it')
+    parser.add_argument('--schedule', type=str, default=None,
+                        help="with --watch, also upload every file on this " +
+                        "schedule, like '1 hour' (see hold_til_)")
+    parser.add_argument('--workers', type=int, default=db_pool_size,
+                        help='how many stations to upload at the same time')
+    args = parser.parse_args()
+
     #########################################################################
     #########################################################################
     # THIS IS THE OTHER SECTION YOU SHOULD KNOW HOW IT WORKS
@@ -259,14 +827,27 @@ if __name__ == '__main__':
                    ['SBSP', datfiledir + 'SBSP-Oct2_2019.dat'],
                    ['PTSP', datfiledir + 'PTSP-Oct2_2019.dat']]
 
+    # EVERY UPLOAD HAS A qc_flags COLUMN, TABLES MADE BEFORE THERE WERE QC
+    # FLAGS GET IT BEFORE THE FIRST ONE
+    for station, filepath in stationlist:
+        if lacks_qc_flags(tablenames[station]):
+            print('Adding qc_flags to %s' % tablenames[station])
+            engine.execute(add_qc_flags_sql % tablenames[station])
+
     # UPLOADING THINGS INITIALLY WHEN WE START THE SCRIPT
-    # LOOPING THROUGH EASH DAT FILE AND UPLOADING TO THE DATABASE
-    for station,filepath in stationlist:
-        print(station)
-        dat = DatFile(station, filepath)    # opening the file
-        if station in ('SASP','SBSP'):
-            dat.add_albedo()
-        dat.upload2db(catch_upload=False)                     # uploading the file
+    # UPLOADING ALL OF THE DAT FILES TO THE DATABASE AT THE SAME TIME
+    ingest_stations(stationlist, args.workers)
+
+    # UPLOADING ONLY THE FILES THAT CHANGE, AS SOON AS THEY CHANGE
+    if args.watch:
+        stations = dict((abspath(fp), st) for st, fp in stationlist)
+
+        def upload_changed(filepaths):
+            ingest_stations([[stations[fp], fp] for fp in filepaths],
+                            args.workers)
+
+        watch_datfiles(list(stations), upload_changed, args.debounce_secs,
+                       schedule=args.schedule)
 
     # LOOPING INDEFINATELY
     while True:
@@ -275,9 +856,5 @@ if __name__ == '__main__':
         time.sleep(5)
         hold_til_('12 min')
 
-        # LOOPING THROUGH EASH DAT FILE AND UPLOADING TO THE DATABASE
-        for station,filepath in stationlist:
-            dat = DatFile(station, filepath)    # opening the file
-            if station in ('SASP','SBSP'):
-                dat.add_albedo()
-            dat.upload2db(catch_upload=False)                     # uploading the file
+        # UPLOADING ALL OF THE DAT FILES TO THE DATABASE AT THE SAME TIME
+        ingest_stations(stationlist, args.workers)